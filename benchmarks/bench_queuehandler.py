@@ -0,0 +1,131 @@
+"""
+Benchmarks for the queue handlers, run against the local testbed stubs.
+
+Each `bench_*` method records its results with :meth:`BenchmarkCase.record`.
+Run them with `benchmarks/run.py`.
+"""
+import os
+import time
+import platform
+
+import flask
+
+import flask_gae as gae
+from flask_gae import serializers
+
+#: Results recorded by every benchmark run in this process.
+RESULTS = {}
+
+
+@gae.pushqueue('default')
+def push_handler(*args, **kwargs):
+    return "OK"
+
+
+#: Number of tasks processed by `pull_handler`.
+PULLED = []
+
+
+@gae.pullqueue('bench-pull', 'default', lease_seconds=60, lease_size=100)
+def pull_handler(rows):
+    for task, data in rows:
+        PULLED.append(data)
+        yield task
+
+
+class BenchmarkCase(gae.testing.TestCase):
+    #: Number of iterations for each benchmark.
+    ITERATIONS = 1000
+
+    taskqueue_stub = {'root_path': os.path.dirname(__file__)}
+
+    def create_app(self):
+        app = flask.Flask(__name__)
+        app.add_url_rule('/push/', view_func=push_handler)
+        app.add_url_rule('/pull/', view_func=pull_handler)
+
+        # Realistic number of other routes for URL lookups.
+        for i in xrange(200):
+            app.add_url_rule('/view/{}/'.format(i), 'view_{}'.format(i),
+                             lambda: "OK")
+        return app
+
+    def record(self, name, seconds, operations, **extra):
+        """
+        Record the time taken for a number of operations.
+        """
+        result = {
+            'seconds': seconds,
+            'operations': operations,
+            'us_per_op': seconds / operations * 1e6,
+            'ops_per_sec': operations / seconds if seconds else None,
+        }
+        result.update(extra)
+        RESULTS[name] = result
+
+    def measure(self, name, func, iterations=None, **extra):
+        iterations = iterations or self.ITERATIONS
+        start = time.time()
+        for _ in xrange(iterations):
+            func()
+        self.record(name, time.time() - start, iterations, **extra)
+
+    def bench_url_lookup(self):
+        with self.app.test_request_context():
+            self.measure('url_lookup', push_handler.url)
+
+    def bench_enqueue(self):
+        with self.app.test_request_context():
+            self.measure('enqueue', lambda: push_handler.queue(1, kw='arg'))
+
+    def bench_enqueue_many(self):
+        calls = [((i,), {'kw': 'arg'}) for i in xrange(self.ITERATIONS)]
+        with self.app.test_request_context():
+            start = time.time()
+            push_handler.queue_many(calls)
+            self.record('enqueue_many', time.time() - start, len(calls))
+
+    def bench_handler(self):
+        payload = serializers.PICKLE.dumps(((1,), {'kw': 'arg'}))
+        headers = {'X-AppEngine-QueueName': 'default',
+                   'Content-Type': serializers.PICKLE.content_type}
+
+        self.measure('push_handler', lambda: self.client.post(
+            '/push/', data=payload, headers=headers))
+
+    def bench_serializers(self):
+        candidates = {
+            'pickle0': serializers.PickleSerializer(protocol=0),
+            'pickle': serializers.PICKLE,
+            'json': serializers.JSON,
+        }
+
+        for size in (100, 10 * 1024, 100 * 1024):
+            obj = ((['x' * 100] * (size // 100),), {'kw': 1})
+            for name, serializer in candidates.iteritems():
+                data = serializer.dumps(obj)
+                self.measure(
+                    'serializer.{}.{}'.format(name, size),
+                    lambda: serializer.loads(serializer.dumps(obj)),
+                    iterations=max(10, self.ITERATIONS // 10),
+                    payload_bytes=len(data))
+
+    def bench_pull(self):
+        pull_handler.push(*range(self.ITERATIONS))
+
+        del PULLED[:]
+        start = time.time()
+        pull_handler._pull(self.app)
+        self.record('pull_loop', time.time() - start, self.ITERATIONS)
+
+        # Make sure the loop did the work rather than bailing out early.
+        self.assertEqual(len(PULLED), self.ITERATIONS)
+        self.assertEqual(pull_handler.queue.lease_tasks(0, 1), [])
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'flask': flask.__version__,
+        'time': time.time(),
+    }
@@ -0,0 +1,73 @@
+"""
+Run the benchmark suite and write the results as JSON.
+
+Usage ::
+
+    python benchmarks/run.py [--output results.json] [--iterations 1000]
+        [--compare previous.json]
+"""
+import os
+import sys
+import json
+import argparse
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import bench_queuehandler  # noqa
+
+
+def run(iterations):
+    bench_queuehandler.BenchmarkCase.ITERATIONS = iterations
+
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'bench'
+    suite = loader.loadTestsFromModule(bench_queuehandler)
+
+    result = unittest.TextTestRunner(verbosity=1).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
+
+    return {
+        'environment': bench_queuehandler.environment(),
+        'iterations': iterations,
+        'results': bench_queuehandler.RESULTS,
+    }
+
+
+def compare(previous, current):
+    """
+    Print the change in time per operation against a previous run.
+    """
+    for name, result in sorted(current['results'].iteritems()):
+        before = previous['results'].get(name)
+        if not before:
+            continue
+        change = (result['us_per_op'] / before['us_per_op'] - 1) * 100
+        print "{:<45} {:>10.2f}us {:>+8.1f}%".format(
+            name, result['us_per_op'], change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', '-o', help="File to write results to")
+    parser.add_argument('--iterations', '-n', type=int, default=1000)
+    parser.add_argument('--compare', '-c',
+                        help="Previous results to compare against")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
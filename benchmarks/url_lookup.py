@@ -0,0 +1,53 @@
+"""
+Compare the endpoint URL lookup used by the queue handlers against the
+previous linear scan of `app.view_functions` inside a
+`test_request_context()`.
+
+Usage ::
+
+    python benchmarks/url_lookup.py [routes] [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask  # noqa
+
+from flask_gae import queuehandler  # noqa
+
+
+def create_app(routes):
+    app = flask.Flask(__name__)
+
+    for i in xrange(routes):
+        app.add_url_rule('/view/{}/'.format(i), 'view_{}'.format(i),
+                         lambda: "OK")
+
+    handler = queuehandler.PushQueueHandler('default')(lambda: "OK")
+    app.add_url_rule('/handler/', 'handler', handler, methods=['POST'])
+    return app, handler
+
+
+def scan_url(app, handler):
+    with app.test_request_context():
+        for endpoint, function in app.view_functions.iteritems():
+            if handler is function:
+                return flask.url_for(endpoint)
+
+
+def main(routes=500, iterations=10000):
+    app, handler = create_app(routes)
+    assert scan_url(app, handler) == handler.url(app)
+
+    scan = timeit.timeit(lambda: scan_url(app, handler), number=iterations)
+    cached = timeit.timeit(lambda: handler.url(app), number=iterations)
+
+    print "{} routes, {} lookups".format(routes, iterations)
+    print "  scan:   {:.2f}us/lookup".format(scan / iterations * 1e6)
+    print "  cached: {:.2f}us/lookup".format(cached / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
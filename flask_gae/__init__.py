@@ -1,14 +1,16 @@
-from .queuehandler import pushqueue, pullqueue
+from .queuehandler import pushqueue, pullqueue, batchqueue, deadletters
 from .decorators import *
 
 try:
     import cloudstorage as gcs
 except ImportError:
-    def send_gcs_file():
+    def send_gcs_file(*args, **kwargs):
         raise NotImplementedError(
             "You need to install GoogleAppengineCloudStorageClient")
+
+    invalidate_gcs_file = send_gcs_file
 else:
-    from .cloudstore import send_gcs_file
+    from .cloudstore import send_gcs_file, invalidate_gcs_file, CachePolicy
 
 try:
     from . import testing
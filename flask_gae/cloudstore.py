@@ -1,26 +1,369 @@
+import re
+import time
 import flask
+import datetime
+import hashlib
 import logging
+import threading
+import collections
+
+from werkzeug.http import (is_resource_modified, parse_if_range_header,
+                           parse_range_header, unquote_etag)
 
 import cloudstorage as gcs
+from cloudstorage import api_utils, common, errors, storage_api
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
 from google.appengine.api import app_identity
 from google.appengine.ext import blobstore
 
 logger = logging.getLogger(__name__)
 
+STAT_CACHE_PREFIX = 'flask_gae.gcs_stat:'
+BLOBKEY_CACHE_PREFIX = 'flask_gae.gcs_blobkey:'
+
+# Cached in place of a stat for files that do not exist.
+_NOT_FOUND = 'NOT_FOUND'
+
+_CachedStat = collections.namedtuple(
+    '_CachedStat', ['content_type', 'etag', 'st_ctime', 'st_size'])
+
+
+class _LRUCache(object):
+    """
+    A thread-safe in-process cache, bounded by entry count, with optional
+    per-entry expiry.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            self._evict()
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'max_size': self.max_size}
+
+    def __len__(self):
+        return len(self._data)
+
+
+_stat_cache = _LRUCache()
+_blobkey_cache = _LRUCache()
+
+
+def _memcache_key(prefix, gcs_filename):
+    if isinstance(gcs_filename, unicode):
+        gcs_filename = gcs_filename.encode('utf-8')
+
+    key = prefix + gcs_filename
+    if len(key) > memcache.MAX_KEY_SIZE:
+        key = prefix + hashlib.sha1(gcs_filename).hexdigest()
+    return key
+
+
+def _stat_cache_ttls(ttl):
+    config = flask.current_app.config
+    if ttl is None:
+        ttl = config.get('GAE_GCS_STAT_CACHE_TTL', 0)
+    not_found_ttl = config.get('GAE_GCS_STAT_CACHE_NOT_FOUND_TTL',
+                               min(ttl, 60))
+    return ttl, not_found_ttl
+
+
+@ndb.tasklet
+def stat_async(filename, retry_params=None):
+    """
+    An asynchronous version of :func:`cloudstorage.stat`.
+
+    :param filename: The GCS filename, in the format `/bucket/filename`.
+    :param retry_params: An optional :class:`cloudstorage.RetryParams`.
+
+    :returns: A future resolving to a :class:`cloudstorage.GCSFileStat`.
+        Raises :class:`cloudstorage.NotFoundError` if the file does not
+        exist.
+    """
+    common.validate_file_path(filename)
+    api = storage_api._get_storage_api(retry_params=retry_params)
+    status, headers, content = yield api.head_object_async(
+        api_utils._quote_filename(filename))
+    errors.check_status(status, [200], filename, resp_headers=headers,
+                        body=content)
+
+    raise ndb.Return(common.GCSFileStat(
+        filename=filename,
+        st_size=common.get_stored_content_length(headers),
+        st_ctime=common.http_time_to_posix(headers.get('last-modified')),
+        etag=headers.get('etag'),
+        content_type=headers.get('content-type'),
+        metadata=common.get_metadata(headers)))
+
+
+@ndb.tasklet
+def _stat_async(gcs_filename, ttl=0, not_found_ttl=0):
+    """
+    Stat a GCS file, reading through the in-process and memcache caches
+    when `ttl` is set. Files that do not exist are cached for
+    `not_found_ttl` seconds.
+
+    Entries found in memcache are kept locally for the full `ttl`, so
+    metadata may be up to twice `ttl` old.
+    """
+    if not ttl:
+        stat = yield stat_async(gcs_filename)
+        raise ndb.Return(stat)
+
+    stat = _stat_cache.get(gcs_filename)
+    if stat is None:
+        ctx = ndb.get_context()
+        key = _memcache_key(STAT_CACHE_PREFIX, gcs_filename)
+        stat = yield ctx.memcache_get(key)
+
+        if stat is None:
+            try:
+                data = yield stat_async(gcs_filename)
+            except gcs.NotFoundError:
+                stat = _NOT_FOUND
+            else:
+                stat = _CachedStat(data.content_type, data.etag,
+                                   data.st_ctime, data.st_size)
+
+            stat_ttl = not_found_ttl if stat == _NOT_FOUND else ttl
+            if stat_ttl:
+                yield ctx.memcache_set(key, stat, time=stat_ttl)
+
+        stat_ttl = not_found_ttl if stat == _NOT_FOUND else ttl
+        if stat_ttl:
+            _stat_cache.set(gcs_filename, stat, ttl=stat_ttl)
+
+    if stat == _NOT_FOUND:
+        raise gcs.NotFoundError(gcs_filename)
+    raise ndb.Return(stat)
+
+
+@ndb.tasklet
+def _blobkey_async(gcs_filename):
+    """
+    :func:`blobstore.create_gs_key_async`, memoized in local memory and,
+    if `GAE_GCS_BLOBKEY_MEMCACHE` is set, memcache. Blob keys for a
+    filename never change, so entries do not expire.
+    """
+    config = flask.current_app.config
+
+    blobkey = None
+    if _blobkey_cache.max_size:
+        blobkey = _blobkey_cache.get(gcs_filename)
+
+    if blobkey is None:
+        ctx = ndb.get_context()
+        key = _memcache_key(BLOBKEY_CACHE_PREFIX, gcs_filename)
+        use_memcache = config.get('GAE_GCS_BLOBKEY_MEMCACHE', False)
+
+        if use_memcache:
+            blobkey = yield ctx.memcache_get(key)
+
+        if blobkey is None:
+            blobkey = yield blobstore.create_gs_key_async(
+                '/gs' + gcs_filename)
+            if use_memcache:
+                yield ctx.memcache_set(key, blobkey)
+
+        if _blobkey_cache.max_size:
+            _blobkey_cache.set(gcs_filename, blobkey)
+
+    raise ndb.Return(blobkey)
+
+
+def set_blobkey_cache_size(max_size):
+    """
+    Set how many blob keys are cached in local memory. The cache is shared
+    by every app in the process. `0` disables it.
+    """
+    _blobkey_cache.resize(max_size)
+
+
+def invalidate_gcs_file(filename, bucket=None):
+    """
+    Drop any cached metadata for a GCS file. Call this after a file has
+    been written or deleted when the stat cache is in use.
+
+    Only the cache of the current instance and memcache are cleared; other
+    instances may serve their own cached metadata until it expires.
+
+    :param filename: The filepath, as passed to :func:`send_gcs_file`.
+    :param bucket: The GCS bucket. If `None`, the default bucket is used.
+    """
+    gcs_filename = '/{}{}'.format(bucket or _default_bucket(), filename)
+    _stat_cache.delete(gcs_filename)
+    memcache.delete(_memcache_key(STAT_CACHE_PREFIX, gcs_filename))
+
+
+def clear_caches():
+    """
+    Clear the in-process caches used by :func:`send_gcs_file`.
+    """
+    _stat_cache.clear()
+    _blobkey_cache.clear()
+
+
+def cache_stats():
+    """
+    Hit and miss counts and sizes of the in-process caches used by
+    :func:`send_gcs_file`, since they were last cleared.
+    """
+    return {'stat': _stat_cache.stats(), 'blobkey': _blobkey_cache.stats()}
+
+
+# Filenames with a content hash of at least 10 lowercase hex digits, e.g.
+# `app.3f2a9c1b7e.js` or `logo-3f2a9c1b7e.png`. Hashes must mix letters
+# and digits, so dates and serial numbers (`report-20240101.pdf`) don't
+# match.
+HASHED_FILENAME = re.compile(
+    r'[.-](?=[0-9a-f]*[a-f])(?=[0-9a-f]*[0-9])[0-9a-f]{10,}\.[^/.]+$')
+
+
+class CachePolicy(object):
+    """
+    `Cache-Control` and `Vary` headers for files served by
+    :func:`send_gcs_file`.
+
+    :param public: If `True` the response may be stored by shared caches,
+        otherwise it is marked `private`.
+    :param max_age: `max-age` in seconds.
+    :param s_maxage: `s-maxage` in seconds, for shared caches such as the
+        Google edge cache.
+    :param immutable: Mark the response `immutable`.
+    :param stale_while_revalidate: `stale-while-revalidate` in seconds.
+    :param stale_if_error: `stale-if-error` in seconds.
+    :param vary: A list of request headers to add to `Vary`.
+    :param hashed_max_age: If set, files whose names contain a content hash
+        are served as `immutable` with this `max-age` instead.
+    :param hashed_pattern: A regular expression (string or compiled)
+        matching filenames with a content hash. Defaults to
+        :data:`HASHED_FILENAME`.
+    """
+    def __init__(self, public=True, max_age=None, s_maxage=None,
+                 immutable=False, stale_while_revalidate=None,
+                 stale_if_error=None, vary=None, hashed_max_age=None,
+                 hashed_pattern=HASHED_FILENAME):
+        self.public = public
+        self.max_age = max_age
+        self.s_maxage = s_maxage
+        self.immutable = immutable
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.vary = vary or []
+        self.hashed_max_age = hashed_max_age
+        if isinstance(hashed_pattern, basestring):
+            hashed_pattern = re.compile(hashed_pattern)
+        self.hashed_pattern = hashed_pattern
+
+    def __repr__(self):
+        return '<CachePolicy {!r}>'.format(self.__dict__)
+
+    def apply(self, resp, filename):
+        """
+        Set the cache headers for `filename` on `resp`.
+        """
+        max_age, immutable = self.max_age, self.immutable
+        if self.hashed_max_age is not None and \
+                self.hashed_pattern.search(filename):
+            max_age, immutable = self.hashed_max_age, True
+
+        cc = resp.cache_control
+        if self.public:
+            cc.public = True
+        else:
+            cc.private = True
+
+        if max_age is not None:
+            cc.max_age = max_age
+        if self.s_maxage is not None:
+            cc.s_maxage = self.s_maxage
+
+        # Not supported as attributes by werkzeug.
+        if immutable:
+            cc['immutable'] = None
+        if self.stale_while_revalidate is not None:
+            cc['stale-while-revalidate'] = str(self.stale_while_revalidate)
+        if self.stale_if_error is not None:
+            cc['stale-if-error'] = str(self.stale_if_error)
+
+        for header in self.vary:
+            resp.vary.add(header)
+
+
+DEFAULT_CACHE_POLICY = CachePolicy()
 
-class LazyStat(object):
-    """Class to lazily call stat()"""
-    # TODO: Make this Async
-    # Dependent on
-    # https://code.google.com/p/appengine-gcs-client/issues/detail?id=13
-    def __init__(self, filename):
-        self.filename = filename
-        self.data = None
 
-    def __getattr__(self, attr):
-        if self.data is None:
-            self.data = gcs.stat(self.filename)
-        return getattr(self.data, attr)
+def _cache_policy(filename, policy=None):
+    """
+    The policy for a file: `policy` if given, else the rule in
+    `GAE_GCS_CACHE_RULES` with the longest matching prefix, else
+    `GAE_GCS_CACHE_POLICY`. Policies may be given as dictionaries of
+    :class:`CachePolicy` arguments.
+    """
+    if policy is None:
+        config = flask.current_app.config
+
+        rules = config.get('GAE_GCS_CACHE_RULES', ())
+        if isinstance(rules, dict):
+            rules = rules.items()
+
+        matches = [(prefix, rule) for prefix, rule in rules
+                   if filename.startswith(prefix)]
+        if matches:
+            policy = max(matches, key=lambda m: len(m[0]))[1]
+        else:
+            policy = config.get('GAE_GCS_CACHE_POLICY')
+
+    if isinstance(policy, dict):
+        policy = CachePolicy(**policy)
+    return policy or DEFAULT_CACHE_POLICY
+
 
 DEFAULT_GCS_BUCKET = None
 
@@ -32,20 +375,64 @@ def _default_bucket():
     return DEFAULT_GCS_BUCKET
 
 
+def _http_date(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.utcfromtimestamp(int(value))
+
+
+def _is_conditional(request):
+    return (request.method in ('GET', 'HEAD') and
+            ('If-None-Match' in request.headers or
+             'If-Modified-Since' in request.headers))
+
+
+def _blob_range(request, etag, last_modified):
+    """
+    The byte range to serve for a request, or `None` to serve the whole
+    file. Only single ranges are supported by the blobstore.
+    """
+    range_header = request.headers.get('Range')
+    ranges = parse_range_header(range_header)
+    if ranges is None or len(ranges.ranges) != 1:
+        return None
+
+    if 'If-Range' in request.headers:
+        if_range = parse_if_range_header(request.headers['If-Range'])
+        if if_range.etag is not None:
+            if not etag or if_range.etag != unquote_etag(etag)[0]:
+                return None
+        elif if_range.date is None or if_range.date != last_modified:
+            return None
+
+    return range_header
+
+
 def send_gcs_file(filename, bucket=None, mimetype=None,
                   add_etags=True, etags=None,
                   add_last_modified=True, last_modified=None,
-                  as_attachment=False, attachment_filename=None):
+                  as_attachment=False, attachment_filename=None,
+                  stat_cache_ttl=None, use_range=True, cache_policy=None):
     """
     Serve a file in Google Cloud Storage (gcs) to the client.
 
     ..note:: When `add_etags`, `add_last_modified` or no `mimetype` is
-      provided, two extra RPC calls will be made to retrieve data from
-      Cloud Storage.
+      provided, an extra RPC call will be made to retrieve data from
+      Cloud Storage. It runs concurrently with creating the blob key.
       If peformance, is a priority, it is advised to provide values for these
       parameters or cache the response with memcache. **But** this will return
       500 responses if the file does not exist in GCS.
 
+      Alternatively, set `GAE_GCS_STAT_CACHE_TTL` in the app config to cache
+      file metadata in local memory and memcache for that many seconds.
+      Missing files are cached for `GAE_GCS_STAT_CACHE_NOT_FOUND_TTL`
+      seconds (default: the lesser of the TTL and 60). Use
+      :func:`invalidate_gcs_file` after changing a file.
+
+      Blob keys are cached in local memory, for up to 1000 files (see
+      :func:`set_blobkey_cache_size`), and in memcache if
+      `GAE_GCS_BLOBKEY_MEMCACHE` is set.
+
 
     :param filename: The filepath to serve from gcs.
 
@@ -68,25 +455,60 @@ def send_gcs_file(filename, bucket=None, mimetype=None,
     :param attachment_filename: the filename for the attachment if it differs
         from the file's filename.
 
+    :param stat_cache_ttl: Override `GAE_GCS_STAT_CACHE_TTL` for this call.
+        `0` disables the cache.
+
+    :param use_range: If `True`, serve the byte range asked for by the
+        request's `Range` header, subject to any `If-Range` header.
+
+    :param cache_policy: A :class:`CachePolicy`, or a dictionary of its
+        arguments, to set the `Cache-Control` header with. Defaults to the
+        app's `GAE_GCS_CACHE_RULES` or `GAE_GCS_CACHE_POLICY` config, or
+        just `public`.
+
+    Conditional requests (`If-None-Match` and `If-Modified-Since`) are
+    answered with a `304 Not Modified` response before a blob key is
+    created.
+
     :returns: A :class:`flask.Response` object.
     """
     try:
 
         bucket = bucket or _default_bucket()
         gcs_filename = '/{}{}'.format(bucket, filename)
-        blobkey = blobstore.create_gs_key_async('/gs' + gcs_filename)
+        request = flask.request
+        conditional = ((add_etags or add_last_modified) and
+                       _is_conditional(request))
+
+        blobkey = None
+        if not conditional:
+            # Create the blob key while we stat the file.
+            blobkey = _blobkey_async(gcs_filename)
 
-        stat = LazyStat(gcs_filename)
+        stat = None
+        if (mimetype is None or (add_etags and not etags) or
+                (add_last_modified and not last_modified)):
+            stat = _stat_async(
+                gcs_filename,
+                *_stat_cache_ttls(stat_cache_ttl)).get_result()
 
         if mimetype is None:
             mimetype = stat.content_type
 
+        etag = (etags or stat.etag) if add_etags else None
+
+        if add_last_modified:
+            last_modified = _http_date(
+                last_modified or (stat.st_ctime or None))
+        else:
+            last_modified = None
+
         resp = flask.current_app.response_class('BLOB', mimetype=mimetype)
 
-        resp.cache_control.public = True
+        _cache_policy(filename, cache_policy).apply(resp, filename)
 
-        if add_etags:
-            resp.set_etag(etags or stat.etag)
+        if etag:
+            resp.set_etag(etag)
 
         if as_attachment:
             if attachment_filename is None:
@@ -95,8 +517,23 @@ def send_gcs_file(filename, bucket=None, mimetype=None,
             resp.headers.add('Content-Disposition', 'attachment',
                              filename=attachment_filename)
 
-        if add_last_modified and (last_modified or stat.st_ctime):
-            resp.last_modified = last_modified or int(stat.st_ctime)
+        if last_modified:
+            resp.last_modified = last_modified
+
+        if conditional and not is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified):
+            resp.status_code = 304
+            resp.data = ''
+            return resp
+
+        if blobkey is None:
+            blobkey = _blobkey_async(gcs_filename)
+
+        if use_range:
+            resp.headers['Accept-Ranges'] = 'bytes'
+            blob_range = _blob_range(request, etag, last_modified)
+            if blob_range:
+                resp.headers[blobstore.BLOB_RANGE_HEADER] = blob_range
 
         resp.headers[blobstore.BLOB_KEY_HEADER] = str(blobkey.get_result())
     except gcs.NotFoundError:
@@ -0,0 +1,185 @@
+"""
+Metrics sinks for the queue handlers.
+
+Handlers report timings (in seconds), counters and gauges to a sink. By
+default metrics are discarded by a :class:`NullSink`; set a different
+default with :func:`set_default_sink`, or pass `metrics_sink` to a handler.
+"""
+import time
+import socket
+import logging
+import threading
+import collections
+
+__all__ = ['NullSink', 'MemorySink', 'LoggingSink', 'StatsdSink',
+           'set_default_sink', 'default_sink', 'timer']
+
+
+class NullSink(object):
+    """
+    Discard all metrics.
+    """
+    enabled = False
+
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+class MemorySink(object):
+    """
+    Aggregate metrics in memory. Useful for tests and benchmarks, or for
+    periodically flushing elsewhere.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = collections.defaultdict(
+                lambda: {'count': 0, 'total': 0.0,
+                         'min': None, 'max': None})
+            self.counters = collections.defaultdict(int)
+            self.gauges = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            stats = self.timings[name]
+            stats['count'] += 1
+            stats['total'] += seconds
+            if stats['min'] is None or seconds < stats['min']:
+                stats['min'] = seconds
+            if stats['max'] is None or seconds > stats['max']:
+                stats['max'] = seconds
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        A copy of the aggregated metrics as plain dictionaries.
+        """
+        with self._lock:
+            return {
+                'timings': {k: dict(v) for k, v in self.timings.iteritems()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+
+class LoggingSink(object):
+    """
+    Log every metric.
+
+    :param logger: The logger to use. Defaults to this module's logger.
+    :param level: The level to log at.
+    """
+    enabled = True
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def timing(self, name, seconds):
+        self.logger.log(self.level, "%s: %.2fms", name, seconds * 1000)
+
+    def incr(self, name, value=1):
+        self.logger.log(self.level, "%s: +%s", name, value)
+
+    def gauge(self, name, value):
+        self.logger.log(self.level, "%s: %s", name, value)
+
+
+class StatsdSink(object):
+    """
+    Send metrics to a statsd server over UDP. Send errors are ignored.
+
+    :param host: The statsd host.
+    :param port: The statsd port.
+    :param prefix: Prefixed to every metric name.
+    """
+    enabled = True
+
+    def __init__(self, host='localhost', port=8125, prefix='flask_gae.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = None
+
+    def _send(self, data):
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM)
+            self._socket.sendto(self.prefix + data, self.address)
+        except (socket.error, IOError):
+            pass
+
+    def timing(self, name, seconds):
+        self._send('{}:{:.3f}|ms'.format(name, seconds * 1000))
+
+    def incr(self, name, value=1):
+        self._send('{}:{}|c'.format(name, value))
+
+    def gauge(self, name, value):
+        self._send('{}:{}|g'.format(name, value))
+
+
+_default_sink = NullSink()
+
+
+def set_default_sink(sink):
+    """
+    Set the sink used by handlers that weren't given one.
+    """
+    global _default_sink
+    _default_sink = sink or NullSink()
+
+
+def default_sink():
+    return _default_sink
+
+
+class _Timer(object):
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.sink.timing(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(sink, name):
+    """
+    Context manager that reports the time taken by its block to `sink`.
+    Costs nothing more than a function call when the sink is disabled.
+    """
+    if not sink.enabled:
+        return _NULL_TIMER
+    return _Timer(sink, name)
@@ -0,0 +1,206 @@
+"""
+Compression and offloading of large task payloads.
+
+Encoded payloads are wrapped in a small envelope naming the encodings that
+were applied, so :func:`decode` can be used on every payload, encoded or
+not.
+"""
+import zlib
+import uuid
+import logging
+
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage as gcs
+except ImportError:
+    gcs = None
+
+__all__ = ['PayloadCodec', 'DatastoreStore', 'GCSStore', 'decode',
+           'cleanup', 'MissingPayloadError']
+
+logger = logging.getLogger(__name__)
+
+MAGIC = '\x00fgae:'
+
+
+class MissingPayloadError(ValueError):
+    """
+    Raised by :func:`decode` when an offloaded payload no longer exists.
+    Payloads are deleted once their task completes, so this usually means
+    the task was delivered again after completing and can be dropped.
+    """
+
+
+class _TaskPayload(ndb.Model):
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class DatastoreStore(object):
+    """
+    Store payloads in the datastore. Payloads must be under 1MB.
+    """
+    name = 'datastore'
+
+    def put(self, data):
+        return _TaskPayload(data=data).put().urlsafe()
+
+    def get(self, ref):
+        inst = ndb.Key(urlsafe=ref).get()
+        if inst is None:
+            raise LookupError("Payload {!r} does not exist".format(ref))
+        return inst.data
+
+    def delete(self, ref):
+        ndb.Key(urlsafe=ref).delete()
+
+
+class GCSStore(object):
+    """
+    Store payloads in Google Cloud Storage. Requires
+    GoogleAppEngineCloudStorageClient.
+
+    :param bucket: The bucket to store payloads in.
+    :param prefix: The path prefix for payload objects.
+    """
+    name = 'gcs'
+
+    def __init__(self, bucket, prefix='/task-payloads/'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, data):
+        if gcs is None:
+            raise NotImplementedError(
+                "You need to install GoogleAppengineCloudStorageClient")
+
+        filename = '/{}{}{}'.format(self.bucket, self.prefix,
+                                    uuid.uuid4().hex)
+        with gcs.open(filename, 'w') as f:
+            f.write(data)
+        return filename
+
+    def get(self, ref):
+        try:
+            with gcs.open(ref) as f:
+                return f.read()
+        except gcs.NotFoundError:
+            raise LookupError("Payload {!r} does not exist".format(ref))
+
+    def delete(self, ref):
+        try:
+            gcs.delete(ref)
+        except gcs.NotFoundError:
+            pass
+
+
+_STORES = {}
+
+
+def register_store(store):
+    """
+    Register a store so payloads offloaded to it can be decoded.
+    """
+    _STORES[store.name] = store
+    return store
+
+register_store(DatastoreStore())
+
+
+class PayloadCodec(object):
+    """
+    Compress and offload payloads that exceed a size.
+
+    :param compress_threshold: Compress payloads larger than this many bytes.
+        `None` disables compression.
+    :param offload_threshold: Store payloads (after compression) larger
+        than this many bytes in `store`, and only send a reference. `None`
+        disables offloading. Push tasks are limited to 100KB including
+        headers, so the default leaves some room.
+    :param store: Where to offload payloads to. Default is the datastore.
+    :param level: The zlib compression level.
+    """
+
+    def __init__(self, compress_threshold=1024, offload_threshold=90 * 1024,
+                 store=None, level=6):
+        self.compress_threshold = compress_threshold
+        self.offload_threshold = offload_threshold
+        self.store = register_store(store or _STORES['datastore'])
+        self.level = level
+
+    def encode(self, data):
+        encodings = []
+
+        if (self.compress_threshold is not None
+                and len(data) > self.compress_threshold):
+            data = zlib.compress(data, self.level)
+            encodings.append('zlib')
+
+        if (self.offload_threshold is not None
+                and len(data) > self.offload_threshold):
+            data = self.store.put(data)
+            encodings.append(self.store.name)
+
+        if not encodings:
+            return data
+        return '{}{}:{}'.format(MAGIC, ','.join(encodings), data)
+
+
+def decode(data):
+    """
+    Reverse :meth:`PayloadCodec.encode`. Payloads without an envelope are
+    returned as-is.
+
+    :returns: A tuple of `(data, refs)` where `refs` should be passed to
+        :func:`cleanup` once the task has completed.
+    :raises MissingPayloadError: If an offloaded payload no longer exists.
+    :raises ValueError: If the payload can not be decoded.
+    """
+    refs = []
+    if not data or not data.startswith(MAGIC):
+        return data, refs
+
+    try:
+        encodings, data = data[len(MAGIC):].split(':', 1)
+        for encoding in reversed(encodings.split(',')):
+            if encoding == 'zlib':
+                data = zlib.decompress(data)
+            else:
+                store = _STORES[encoding]
+                refs.append((store, data))
+                try:
+                    data = store.get(data)
+                except LookupError as e:
+                    raise MissingPayloadError(
+                        "Unable to decode payload: {!r}".format(e))
+    except (zlib.error, LookupError) as e:
+        raise ValueError("Unable to decode payload: {!r}".format(e))
+    return data, refs
+
+
+def offloaded_refs(data):
+    """
+    The refs of an encoded payload's offloaded data, found without fetching
+    it. Used to clean up after a task that was never added.
+    """
+    if not data or not data.startswith(MAGIC):
+        return []
+
+    encodings, ref = data[len(MAGIC):].split(':', 1)
+    store = _STORES.get(encodings.split(',')[-1])
+    if store is None:
+        return []
+    return [(store, ref)]
+
+
+def cleanup(refs):
+    """
+    Delete offloaded payloads. Failures are logged and ignored.
+    """
+    for store, ref in refs:
+        try:
+            store.delete(ref)
+        except Exception:
+            logger.exception("Failed to delete payload %r from %s",
+                             ref, store.name)
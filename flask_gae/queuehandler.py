@@ -1,16 +1,103 @@
+import re
 import time
-from datetime import timedelta
+import uuid
+import hashlib
+import Queue
+import random
+import weakref
+import threading
+import itertools
+import collections
+from datetime import datetime, timedelta
 import logging
+import traceback
 import cPickle as pickle
 from functools import update_wrapper
 
 from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import modules
 from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
 from google.appengine.api import app_identity
 from google.appengine.api import urlfetch
 from google.appengine.api.background_thread import start_new_background_thread
+from google.appengine.runtime import apiproxy_errors
 
 import flask
+from werkzeug.local import LocalProxy
+
+from . import metrics
+from . import payloads
+from . import serializers
+from .decorators import requires, Administrator, Cron
+
+
+#: The maximum number of tasks that can be added to a queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+#: The maximum number of tasks that can be added in one transaction.
+MAX_TRANSACTIONAL_TASKS = 5
+
+#: The maximum number of tasks that can be leased in one call.
+MAX_TASKS_PER_LEASE = 1000
+
+#: Errors after which an add may still have succeeded, so the payloads of
+#: the tasks are not cleaned up.
+_UNCERTAIN_ADD_ERRORS = (taskqueue.TransientError, taskqueue.InternalError,
+                         apiproxy_errors.DeadlineExceededError)
+
+
+#: Per-app cache of handler -> endpoint name.
+_ENDPOINTS = weakref.WeakKeyDictionary()
+
+
+def _handler_endpoint(app, handler):
+    """
+    Find the endpoint name `handler` is registered under in `app`.
+
+    The result is cached per-app and checked against `app.view_functions`
+    on each lookup, so rules added or blueprints registered later are
+    picked up.
+    """
+    if isinstance(app, LocalProxy):
+        # Proxies can't be weakly referenced.
+        app = app._get_current_object()
+
+    endpoints = _ENDPOINTS.setdefault(app, {})
+    endpoint = endpoints.get(handler)
+    if endpoint is not None and app.view_functions.get(endpoint) is handler:
+        return endpoint
+
+    for endpoint, function in app.view_functions.iteritems():
+        if handler is function:
+            endpoints[handler] = endpoint
+            return endpoint
+    raise RuntimeError("Unable to find the endpoint name")
+
+
+_INVALID_TASK_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_-]')
+
+
+def _task_name_part(value):
+    """
+    Replace the characters not allowed in task names, such as the dots in
+    blueprint endpoints, with underscores.
+    """
+    return _INVALID_TASK_NAME_CHARS.sub('_', value)
+
+
+def _handler_url(app, handler, **values):
+    """
+    Build the URL path for `handler` without needing a request context.
+    """
+    endpoint = _handler_endpoint(app, handler)
+    app.inject_url_defaults(endpoint, values)
+
+    adapter = app.url_map.bind(
+        app.config.get('SERVER_NAME') or 'localhost',
+        script_name=app.config.get('APPLICATION_ROOT') or '/')
+    return adapter.build(endpoint, values)
 
 
 def task_retry_count():
@@ -29,14 +116,57 @@ class PushQueueHandler(object):
     A decorator to turn a view into an AppEngine push-queue handler.
 
     :param queue_name: The queue name to enqueue jobs for this handler on.
+    :param serializer: The serializer for task payloads. See
+        :mod:`flask_gae.serializers`.
+    :param codec: A :class:`flask_gae.payloads.PayloadCodec` to compress or
+        offload large payloads with.
+    :param dedupe: A function called with the args and kwargs passed to
+        :meth:`queue` that returns a key for the call. Calls with the same
+        key within `dedupe_window` seconds are only enqueued once. Named or
+        transactional calls are never deduplicated.
+    :param dedupe_window: The length, in seconds, of the deduplication
+        window.
+    :param retry_options: A `taskqueue.TaskRetryOptions` for the queued
+        tasks, e.g. to set exponential backoff.
+    :param max_attempts: If set, a task that fails this many times is moved
+        to the dead letters instead of being retried. See
+        :func:`replay_dead_tasks`.
+    :param dead_letter_queue: A pull queue to store dead tasks on. If not
+        set, dead tasks are stored in the datastore.
+    :param metrics_sink: Where to report execution metrics. Defaults to
+        :func:`flask_gae.metrics.default_sink`.
     """
 
     QUEUE_ARGS = ['app', 'eta', 'name', 'target', 'transactional']
 
-    def __init__(self, queue_name='default'):
+    #: Object that provides dumps/loads and a content_type. Default
+    #: is highest-protocol cPickle.
+    serializer = serializers.PICKLE
+
+    #: Errors raised when adding a task whose name was already used.
+    DUPLICATE_ERRORS = (taskqueue.TaskAlreadyExistsError,
+                        taskqueue.TombstonedTaskError)
+
+    def __init__(self, queue_name='default', serializer=None, codec=None,
+                 dedupe=None, dedupe_window=60, retry_options=None,
+                 max_attempts=None, dead_letter_queue=None,
+                 metrics_sink=None):
         self.queue_name = queue_name
+        self.metrics_sink = metrics_sink
+        self.retry_options = retry_options
+        self.max_attempts = max_attempts
+        self.dead_letter_queue = dead_letter_queue
+        self.codec = codec
+        self.dedupe = dedupe
+        self.dedupe_window = dedupe_window
         self.func = None
 
+        self._seen = {}
+        self._seen_lock = threading.Lock()
+
+        if serializer is not None:
+            self.serializer = serializer
+
     def __call__(self, func=None):
         if self.func is None:
             self.func = func
@@ -52,24 +182,106 @@ class PushQueueHandler(object):
     def methods(self):
         return ['post']
 
+    @property
+    def sink(self):
+        return self.metrics_sink or metrics.default_sink()
+
+    def _metric(self, name):
+        return 'push.{}.{}'.format(self.__name__, name)
+
     def _request_handler(self):
         queue_name = flask.request.headers.get('X-AppEngine-QueueName')
         if not queue_name:
             flask.abort(403, "This is a taskqueue endpoint.")
 
+        serializer = serializers.for_content_type(flask.request.mimetype)
+        sink = self.sink
+        if sink.enabled:
+            self._record_queue_delay(sink)
+
         try:
-            args, kwargs = pickle.loads(flask.request.data)
-            resp = self.func(*args, **kwargs)
-            if hasattr(resp, 'get_result'):
-                resp.get_result()
+            with metrics.timer(sink, self._metric('deserialize')):
+                data, refs = payloads.decode(flask.request.data)
+                payload = serializer.loads(data)
+            self._run(payload)
+        except payloads.MissingPayloadError:
+            # Tasks are delivered at least once; a redelivered task's
+            # payload has already been cleaned up.
+            self.logger.warning("Payload missing, assuming the task has "
+                                "already completed", exc_info=True)
+            sink.incr(self._metric('missing_payloads'))
+            return "Task already completed"
         except Exception:
             self.logger.exception(
                 "Task execution failed on attempt #%s",
                 task_retry_count())
+            sink.incr(self._metric('failures'))
+
+            attempts = (task_retry_count() or 0) + 1
+            if self.max_attempts and attempts >= self.max_attempts:
+                self._dead_letter(queue_name, attempts)
+                sink.incr(self._metric('dead_letters'))
+                return "Task moved to dead letters"
 
             return "Task execution failed", 500
+
+        payloads.cleanup(refs)
+        sink.incr(self._metric('successes'))
         return "View completed successfully"
 
+    def _record_queue_delay(self, sink):
+        """
+        Report the time between the task's ETA and now.
+        """
+        try:
+            eta = float(flask.request.headers['X-AppEngine-TaskETA'])
+        except (KeyError, ValueError):
+            return
+        sink.timing(self._metric('queue_delay'), time.time() - eta)
+
+    def _dead_letter(self, queue_name, attempts, payload=None, error=None):
+        """
+        Store the current task so it can be inspected or replayed later.
+
+        :param payload: Store this instead of the current task's payload.
+        :param error: The error text. Defaults to the current traceback.
+        """
+        dead = _DeadTask(
+            url=flask.request.path,
+            queue_name=queue_name,
+            task_name=flask.request.headers.get('X-AppEngine-TaskName'),
+            content_type=flask.request.headers.get('Content-Type'),
+            payload=flask.request.data if payload is None else payload,
+            attempts=attempts,
+            error=error or traceback.format_exc(),
+            module=modules.get_current_module_name(),
+            version=modules.get_current_version_name())
+
+        self.logger.error("Task %r failed %i times, moving to dead letters",
+                          dead.task_name, attempts)
+
+        if self.dead_letter_queue:
+            taskqueue.Queue(self.dead_letter_queue).add(taskqueue.Task(
+                payload=pickle.dumps(dead.to_dict(), pickle.HIGHEST_PROTOCOL),
+                method='PULL',
+                tag=queue_name))
+        else:
+            dead.put()
+
+    def _run(self, payload):
+        args, kwargs = payload
+        with metrics.timer(self.sink, self._metric('execute')):
+            resp = self.func(*args, **kwargs)
+        if hasattr(resp, 'get_result'):
+            with metrics.timer(self.sink, self._metric('future')):
+                resp.get_result()
+
+    def _dumps(self, obj):
+        payload = self.serializer.dumps(obj)
+        if self.codec is not None:
+            payload = self.codec.encode(payload)
+        return payload
+
     def queue(self, *args, **kwargs):
         """
         Enqueue the function to be called with the given args and keyword
@@ -82,22 +294,75 @@ class PushQueueHandler(object):
         :param _name: The task name.
         """
         queue_args = self._pop_tq_add_args(kwargs)
-        app = queue_args.pop('app', None) or flask.current_app
+        url = self.url(queue_args.pop('app', None))
 
-        with app.test_request_context():
-            # flask.url_for uses the request context if it is present
-            # as we're most likely in a request context, use a
-            # test_request_context() instead.
-            url = self.url()
+        deduped = self._dedupe_task_name(args, kwargs, queue_args)
+        if deduped is False:
+            return
 
-        payload = pickle.dumps((args, kwargs))
+        if self.retry_options is not None:
+            queue_args['retry_options'] = self.retry_options
 
-        taskqueue.add(
-            url=url,
-            queue_name=self.queue_name,
-            payload=payload,
-            **queue_args
-        )
+        payload = self._dumps((args, kwargs))
+        try:
+            taskqueue.add(
+                url=url,
+                queue_name=self.queue_name,
+                payload=payload,
+                headers={'Content-Type': self.serializer.content_type},
+                **queue_args
+            )
+        except self.DUPLICATE_ERRORS:
+            payloads.cleanup(payloads.offloaded_refs(payload))
+            if not deduped:
+                raise
+            self.logger.debug("Task %r already queued", queue_args['name'])
+        except Exception as e:
+            if not isinstance(e, _UNCERTAIN_ADD_ERRORS):
+                payloads.cleanup(payloads.offloaded_refs(payload))
+            if deduped:
+                self._forget_seen([queue_args['name']])
+            raise
+
+    def _dedupe_task_name(self, args, kwargs, queue_args):
+        """
+        Name the task after its dedupe key and the current dedupe window.
+
+        :returns: `None` if the task isn't being deduplicated, `False` if
+            this process has already queued it in this window, otherwise
+            `True`.
+        """
+        if (self.dedupe is None or queue_args.get('name')
+                or queue_args.get('transactional')):
+            return None
+
+        now = time.time()
+        key = self.dedupe(*args, **kwargs)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        key = '{}.{}\x00{}'.format(self.__module__, self.__name__, key)
+        name = 'dedupe-{}-{}'.format(hashlib.sha1(key).hexdigest(),
+                                     int(now // self.dedupe_window))
+        queue_args['name'] = name
+
+        with self._seen_lock:
+            if self._seen.get(name, 0) > now:
+                return False
+
+            if len(self._seen) > 1000:
+                self._seen = {n: expires for n, expires
+                              in self._seen.iteritems() if expires > now}
+            self._seen[name] = now + self.dedupe_window
+        return True
+
+    def _forget_seen(self, names):
+        """
+        Forget dedupe names whose tasks failed to be added, so they can be
+        queued again.
+        """
+        with self._seen_lock:
+            for name in names:
+                self._seen.pop(name, None)
 
     def _pop_tq_add_args(self, kwargs):
         """
@@ -108,22 +373,468 @@ class PushQueueHandler(object):
             x: kwargs.pop('_' + x, None) for x in self.QUEUE_ARGS
         }
 
-    def url(self):
-        for endpoint, function in flask.current_app.view_functions.iteritems():
-            if self is function:
-                return flask.url_for(endpoint)
-        raise RuntimeError("Unable to find the endpoint name")
+    def url(self, app=None):
+        """
+        The URL path of this handler.
+
+        :param app: The application to build the URL with. Defaults to the
+            current app.
+        """
+        return _handler_url(app or flask.current_app, self)
+
+    def batch(self, app=None, transactional=False, use_async=False):
+        """
+        Create a :class:`PushTaskBatch` to enqueue many calls to this handler
+        with as few RPCs as possible.
+
+        :param app: The optional application to use for routing.
+        :param transactional: Enqueue the tasks in a transaction.
+        :param use_async: Add each chunk of tasks with `Queue.add_async`
+            and only wait for the results when the batch is flushed.
+        """
+        return PushTaskBatch(self, app=app, transactional=transactional,
+                             use_async=use_async)
+
+    def queue_many(self, calls, _app=None, _transactional=False,
+                   _async=False):
+        """
+        Enqueue the function to be called once for every `(args, kwargs)`
+        pair in `calls`. Tasks are added in chunks of
+        :data:`MAX_TASKS_PER_ADD`.
+
+        The `kwargs` of each call can contain `_eta`, `_name` and `_target`
+        as per :meth:`queue`.
+
+        :raises BatchEnqueueError: If any of the chunks failed to be added.
+        """
+        with self.batch(app=_app, transactional=_transactional,
+                        use_async=_async) as batch:
+            for args, kwargs in calls:
+                batch.queue(*args, **dict(kwargs))
+
+    def _make_task(self, url, args, kwargs, task_args):
+        if self.retry_options is not None:
+            task_args['retry_options'] = self.retry_options
+
+        return taskqueue.Task(
+            url=url,
+            payload=self._dumps((args, kwargs)),
+            headers={'Content-Type': self.serializer.content_type},
+            **task_args
+        )
 
 
 pushqueue = PushQueueHandler
 
 
+class BatchTaskError(Exception):
+    """
+    Raised when every item of a batched push task failed.
+    """
+
+
+class PushQueueBatchHandler(PushQueueHandler):
+    """
+    A :class:`PushQueueHandler` that delivers many queued calls in a single
+    task.
+
+    Calls queued during a request are buffered and added, once the request
+    returns a response with a status below 400, as tasks of up to
+    `batch_size` calls each. If the request fails the buffered calls are
+    dropped, so a retried task does not add them twice.
+    Calls queued outside of a request, or with any of the `_eta`, `_name`,
+    `_target` or `_transactional` arguments, are added immediately.
+
+    Each call in a task is run separately. If only some of them fail, the
+    failed calls are queued again as a new task and the original task
+    succeeds, so successful calls are not repeated. Re-queued calls keep
+    count of their attempts, and are moved to the dead letters on their
+    own once they reach `max_attempts`.
+
+    :param batch_size: The maximum number of calls per task.
+    """
+
+    def __init__(self, queue_name='default', batch_size=100, **kwargs):
+        super(PushQueueBatchHandler, self).__init__(queue_name, **kwargs)
+        self.batch_size = batch_size
+
+    def queue(self, *args, **kwargs):
+        """
+        Enqueue the function to be called with the given args and keyword
+        arguments. Accepts the same arguments as
+        :meth:`PushQueueHandler.queue`.
+        """
+        queue_args = self._pop_tq_add_args(kwargs)
+        app = queue_args.pop('app', None)
+
+        if any(queue_args.itervalues()) or not flask.has_request_context():
+            self._add_items([(args, kwargs)], app, **queue_args)
+            return
+
+        buffers = getattr(flask.g, '_flask_gae_push_buffers', None)
+        if buffers is None:
+            buffers = flask.g._flask_gae_push_buffers = {}
+
+        if self not in buffers:
+            buffers[self] = []
+
+            @flask.after_this_request
+            def flush(response):
+                items = buffers.pop(self)
+                if response.status_code < 400:
+                    self._add_items(items, app)
+                return response
+
+        buffers[self].append((args, kwargs))
+
+    def _add_items(self, items, app=None, transactional=None, **task_args):
+        url = self.url(app)
+        headers = {'Content-Type': self.serializer.content_type}
+
+        tasks = [
+            taskqueue.Task(url=url,
+                           payload=self._dumps(items[i:i + self.batch_size]),
+                           headers=headers,
+                           retry_options=self.retry_options,
+                           **task_args)
+            for i in xrange(0, len(items), self.batch_size)]
+
+        queue = taskqueue.Queue(self.queue_name)
+        for i in xrange(0, len(tasks), MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + MAX_TASKS_PER_ADD],
+                      transactional=bool(transactional))
+
+    def _run(self, items):
+        sink = self.sink
+        sink.gauge(self._metric('batch_size'), len(items))
+
+        # Re-queued calls carry the number of attempts made before this
+        # task, so poison calls still reach `max_attempts`.
+        attempts = (task_retry_count() or 0) + 1
+        calls = []
+        for item in items:
+            args, kwargs, previous = (tuple(item) + (0,))[:3]
+            calls.append((args, kwargs, previous + attempts))
+
+        # Start every call before waiting on any futures they return, so
+        # tasklets can run concurrently.
+        started = []
+        failed = []
+        with metrics.timer(sink, self._metric('execute')):
+            for args, kwargs, call_attempts in calls:
+                try:
+                    resp = self.func(*args, **kwargs)
+                except Exception:
+                    self.logger.exception("Batched call failed")
+                    failed.append((args, kwargs, call_attempts,
+                                   traceback.format_exc()))
+                else:
+                    started.append((args, kwargs, call_attempts, resp))
+
+        with metrics.timer(sink, self._metric('future')):
+            for args, kwargs, call_attempts, resp in started:
+                if not hasattr(resp, 'get_result'):
+                    continue
+                try:
+                    resp.get_result()
+                except Exception:
+                    self.logger.exception("Batched call failed")
+                    failed.append((args, kwargs, call_attempts,
+                                   traceback.format_exc()))
+
+        sink.incr(self._metric('item_failures'), len(failed))
+        if not failed:
+            return
+
+        retry = []
+        for args, kwargs, call_attempts, error in failed:
+            if self.max_attempts and call_attempts >= self.max_attempts:
+                self._dead_letter(
+                    flask.request.headers.get('X-AppEngine-QueueName'),
+                    call_attempts,
+                    payload=self._dumps([(args, kwargs)]),
+                    error=error)
+                sink.incr(self._metric('dead_letters'))
+            else:
+                retry.append((args, kwargs, call_attempts))
+
+        if len(retry) == len(items):
+            raise BatchTaskError(
+                "All {} batched calls failed".format(len(items)))
+
+        if retry:
+            self.logger.warning("Re-queueing %i of %i failed batched calls",
+                                len(retry), len(items))
+            self._add_items(retry)
+
+
+batchqueue = PushQueueBatchHandler
+
+
+class _DeadTask(ndb.Model):
+    """
+    A push task that failed `max_attempts` times, along with the module and
+    version it ran on so a replay goes back to the same code.
+    """
+    url = ndb.StringProperty()
+    queue_name = ndb.StringProperty()
+    task_name = ndb.StringProperty(indexed=False)
+    content_type = ndb.StringProperty(indexed=False)
+    payload = ndb.BlobProperty()
+    attempts = ndb.IntegerProperty(indexed=False)
+    error = ndb.TextProperty()
+    module = ndb.StringProperty(indexed=False)
+    version = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @property
+    def target(self):
+        if self.module and self.version:
+            return '{}.{}'.format(self.version, self.module)
+        return self.module
+
+    def to_task(self):
+        headers = {}
+        if self.content_type:
+            headers['Content-Type'] = self.content_type
+        return taskqueue.Task(url=self.url, payload=self.payload,
+                              headers=headers, target=self.target)
+
+
+def replay_dead_tasks(queue_name=None, limit=100, dead_letter_queue=None):
+    """
+    Add dead tasks back onto the queues they failed on.
+
+    :param queue_name: Only replay tasks that failed on this queue.
+    :param limit: The maximum number of tasks to replay. Tasks are leased
+        from a `dead_letter_queue` at most :data:`MAX_TASKS_PER_LEASE` at a
+        time, so it is capped at that.
+    :param dead_letter_queue: Replay tasks from this pull queue, rather than
+        from the datastore.
+
+    :returns: The number of tasks replayed.
+    """
+    if dead_letter_queue:
+        limit = min(limit, MAX_TASKS_PER_LEASE)
+        dlq = taskqueue.Queue(dead_letter_queue)
+        if queue_name:
+            leased = dlq.lease_tasks_by_tag(60, limit, queue_name)
+        else:
+            leased = dlq.lease_tasks(60, limit)
+        dead = [_DeadTask(**pickle.loads(t.payload)) for t in leased]
+    else:
+        query = _DeadTask.query()
+        if queue_name:
+            query = query.filter(_DeadTask.queue_name == queue_name)
+        dead = query.fetch(limit)
+
+    by_queue = collections.defaultdict(list)
+    for d in dead:
+        by_queue[d.queue_name].append(d.to_task())
+
+    for name, tasks in by_queue.iteritems():
+        queue = taskqueue.Queue(name)
+        for i in xrange(0, len(tasks), MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+
+    if dead_letter_queue:
+        dlq.delete_tasks(leased)
+    else:
+        ndb.delete_multi([d.key for d in dead])
+
+    return len(dead)
+
+
+#: Blueprint with an endpoint to replay dead tasks. Register it on the app
+#: with a URL prefix and POST to `<prefix>/replay` with optional `queue`,
+#: `limit` and `dead_letter_queue` form values.
+deadletters = flask.Blueprint('flask_gae_deadletters', __name__)
+
+
+@deadletters.route('/replay', methods=['POST'])
+@requires(Administrator | Cron)
+def replay_dead_tasks_view():
+    try:
+        limit = int(flask.request.values.get('limit', 100))
+    except ValueError:
+        flask.abort(400, "Invalid limit")
+    if limit < 1:
+        flask.abort(400, "Invalid limit")
+
+    replayed = replay_dead_tasks(
+        queue_name=flask.request.values.get('queue'),
+        limit=limit,
+        dead_letter_queue=flask.request.values.get('dead_letter_queue'))
+    return "Replayed {} tasks".format(replayed)
+
+
+class BatchEnqueueError(Exception):
+    """
+    Raised when one or more chunks of a :class:`PushTaskBatch` could not be
+    added to the queue.
+
+    :attr failures: A list of `(tasks, exception)` tuples, one for each
+        chunk that failed.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(BatchEnqueueError, self).__init__(
+            "{} of the task chunks failed to be added".format(len(failures)))
+
+
+class PushTaskBatch(object):
+    """
+    Accumulate tasks for a :class:`PushQueueHandler` and add them to the queue
+    in chunks of :data:`MAX_TASKS_PER_ADD`.
+
+    The endpoint URL is resolved once for the whole batch. Any remaining
+    tasks are added when the context manager exits cleanly. Transactional
+    batches are limited to :data:`MAX_TRANSACTIONAL_TASKS` tasks.
+
+    Usage ::
+
+        with my_queue_handler.batch() as batch:
+            for i in xrange(50000):
+                batch.queue(i, kw='arg')
+    """
+
+    def __init__(self, handler, app=None, transactional=False,
+                 use_async=False):
+        self.handler = handler
+        self.transactional = transactional
+        self.use_async = use_async
+        self.url = handler.url(app)
+
+        self.tasks = []
+        self.rpcs = []
+        self.failures = []
+        self.queued = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def queue(self, *args, **kwargs):
+        """
+        Add a call to the batch. Accepts the same arguments as
+        :meth:`PushQueueHandler.queue`, except `_app` and `_transactional`
+        which are set on the batch.
+        """
+        task_args = self.handler._pop_tq_add_args(kwargs)
+        if task_args.pop('app') or task_args.pop('transactional'):
+            raise TypeError(
+                "_app and _transactional must be provided to the batch")
+
+        if not self.transactional:
+            deduped = self.handler._dedupe_task_name(args, kwargs, task_args)
+            if deduped is False:
+                return
+        elif self.queued >= MAX_TRANSACTIONAL_TASKS:
+            raise taskqueue.TooManyTasksError(
+                "Only {} tasks can be added in a transaction".format(
+                    MAX_TRANSACTIONAL_TASKS))
+
+        self.queued += 1
+        self.tasks.append(self.handler._make_task(
+            self.url, args, kwargs, task_args))
+
+        if len(self.tasks) >= MAX_TASKS_PER_ADD:
+            self._add_chunk()
+
+    def _add_chunk(self):
+        tasks, self.tasks = self.tasks, []
+        queue = taskqueue.Queue(self.handler.queue_name)
+
+        if self.use_async:
+            self.rpcs.append((tasks, queue.add_async(
+                tasks, transactional=self.transactional)))
+            return
+
+        try:
+            queue.add(tasks, transactional=self.transactional)
+        except Exception as e:
+            self._failed(tasks, e)
+
+    def _is_duplicate(self, exception):
+        # Tasks named by dedupe keys that already exist don't need adding.
+        return (self.handler.dedupe is not None and
+                isinstance(exception, self.handler.DUPLICATE_ERRORS))
+
+    def _failed(self, tasks, exception):
+        if not isinstance(exception, _UNCERTAIN_ADD_ERRORS):
+            # Tasks that weren't added won't clean up their own payloads.
+            payloads.cleanup([
+                ref for t in tasks if not t.was_enqueued
+                for ref in payloads.offloaded_refs(t.payload)])
+
+        if self._is_duplicate(exception):
+            return
+
+        self.handler.logger.error(
+            "Failed to add %i tasks to %r: %r",
+            len(tasks), self.handler.queue_name, exception)
+        if self.handler.dedupe is not None:
+            self.handler._forget_seen([t.name for t in tasks])
+        self.failures.append((tasks, exception))
+
+    def flush(self):
+        """
+        Add any pending tasks and wait for any outstanding asynchronous adds.
+
+        :raises BatchEnqueueError: If any of the chunks failed to be added.
+        """
+        if self.tasks:
+            self._add_chunk()
+
+        rpcs, self.rpcs = self.rpcs, []
+        for tasks, rpc in rpcs:
+            try:
+                rpc.get_result()
+            except Exception as e:
+                self._failed(tasks, e)
+
+        if self.failures:
+            failures, self.failures = self.failures, []
+            raise BatchEnqueueError(failures)
+
+
+class _RPCGroup(object):
+    """
+    Wait on several RPCs as if they were one.
+    """
+
+    def __init__(self, rpcs):
+        self.rpcs = rpcs
+
+    def get_result(self):
+        results = []
+        error = None
+        for rpc in self.rpcs:
+            try:
+                result = rpc.get_result()
+            except Exception as e:
+                error = error or e
+            else:
+                if isinstance(result, list):
+                    results.extend(result)
+                else:
+                    results.append(result)
+
+        if error is not None:
+            raise error
+        return results
+
+
 class _PullWorkerLock(ndb.Model):
     count = ndb.IntegerProperty(default=0)
 
     @classmethod
     @ndb.transactional(retries=10)
-    def acquire(cls, id, max_workers=1):
+    def acquire(cls, id, max_workers=1, ttl=None):
         inst = cls.get_or_insert(id)
         if inst.count >= max_workers:
             return False
@@ -144,6 +855,282 @@ class _PullWorkerLock(ndb.Model):
         inst.put()
         return inst
 
+    def refresh(self):
+        return True
+
+    @classmethod
+    def active_workers(cls, id, max_workers=1):
+        inst = cls.get_by_id(id)
+        return inst.count if inst else 0
+
+
+class _PullWorkerSlot(ndb.Model):
+    """
+    One of `max_workers` worker slots for a queue.
+
+    Each slot is a separate entity group, so workers acquiring different
+    slots don't contend with each other. A slot expires `ttl` seconds after
+    it was last refreshed, so a worker that dies without releasing it
+    doesn't hold it forever.
+    """
+    holder = ndb.StringProperty(indexed=False)
+    expires = ndb.DateTimeProperty(indexed=False)
+    ttl = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def _slot_keys(cls, id, max_workers):
+        return [ndb.Key(cls, '{}:{}'.format(id, i))
+                for i in xrange(max_workers)]
+
+    @classmethod
+    def acquire(cls, id, max_workers=1, ttl=600):
+        return cls._acquire_any(cls._slot_keys(id, max_workers), ttl)
+
+    @classmethod
+    def _acquire_any(cls, keys, ttl):
+        # Spread concurrent workers over the slots.
+        random.shuffle(keys)
+
+        holder = uuid.uuid4().hex
+        now = datetime.utcnow()
+        slots = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+
+        for key, inst in zip(keys, slots):
+            if inst is not None and inst.expires > now:
+                continue
+            try:
+                slot = cls._claim(key, holder, ttl)
+            except datastore_errors.TransactionFailedError:
+                # Another worker is claiming this slot, try the next one.
+                continue
+            if slot:
+                return slot
+        return False
+
+    @classmethod
+    def active_workers(cls, id, max_workers=1):
+        now = datetime.utcnow()
+        slots = ndb.get_multi(cls._slot_keys(id, max_workers),
+                              use_cache=False, use_memcache=False)
+        return sum(1 for s in slots if s is not None and s.expires > now)
+
+    @classmethod
+    @ndb.transactional(retries=0)
+    def _claim(cls, key, holder, ttl):
+        inst = key.get()
+        now = datetime.utcnow()
+        if inst is not None and inst.expires > now:
+            return False
+
+        inst = cls(key=key, holder=holder, ttl=ttl,
+                   expires=now + timedelta(seconds=ttl))
+        inst.put()
+        return inst
+
+    @ndb.transactional(retries=3)
+    def refresh(self):
+        """
+        Extend the slot's expiry.
+
+        :returns: `False` if the slot has expired and been taken by another
+            worker.
+        """
+        inst = self.key.get()
+        if inst is None or inst.holder != self.holder:
+            logging.warning("Pull worker slot %s was lost", self.key.id())
+            return False
+
+        inst.expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+        inst.put()
+        self.expires = inst.expires
+        return True
+
+    @ndb.transactional(retries=3)
+    def release(self):
+        inst = self.key.get()
+        if inst is not None and inst.holder == self.holder:
+            inst.key.delete()
+
+
+class _MemcachePullWorkerSlot(_PullWorkerSlot):
+    """
+    A :class:`_PullWorkerSlot` with held slots mirrored in memcache.
+
+    Checking whether all slots are taken is a single memcache `get_multi`,
+    and only slots that memcache doesn't know to be held are claimed in the
+    datastore. The datastore stays authoritative, so an evicted memcache
+    entry only costs an extra transaction.
+
+    Refreshing updates memcache every time, but only writes to the
+    datastore once half of `ttl` has passed. Slots of workers that stop
+    refreshing expire from both.
+    """
+    MEMCACHE_PREFIX = 'flask_gae.pullworker:'
+
+    @classmethod
+    def acquire(cls, id, max_workers=1, ttl=600):
+        keys = cls._slot_keys(id, max_workers)
+        held = memcache.get_multi([k.id() for k in keys],
+                                  key_prefix=cls.MEMCACHE_PREFIX)
+        if len(held) >= max_workers:
+            return False
+
+        slot = cls._acquire_any(
+            [k for k in keys if k.id() not in held], ttl)
+        if slot:
+            slot._heartbeat()
+        return slot
+
+    @classmethod
+    def active_workers(cls, id, max_workers=1):
+        keys = cls._slot_keys(id, max_workers)
+        return len(memcache.get_multi([k.id() for k in keys],
+                                      key_prefix=cls.MEMCACHE_PREFIX))
+
+    def _heartbeat(self):
+        memcache.set(self.MEMCACHE_PREFIX + self.key.id(), self.holder,
+                     time=self.ttl)
+
+    def refresh(self):
+        remaining = self.expires - datetime.utcnow()
+        if remaining > timedelta(seconds=self.ttl / 2.0):
+            self._heartbeat()
+            return True
+
+        if not super(_MemcachePullWorkerSlot, self).refresh():
+            return False
+        self._heartbeat()
+        return True
+
+    def release(self):
+        memcache.delete(self.MEMCACHE_PREFIX + self.key.id())
+        super(_MemcachePullWorkerSlot, self).release()
+
+
+#: Lock implementations that can be passed to :class:`PullQueueHandler`
+#: by name.
+LOCKS = {
+    'datastore': _PullWorkerLock,
+    'sharded': _PullWorkerSlot,
+    'memcache': _MemcachePullWorkerSlot,
+}
+
+
+class _TaskDeleter(object):
+    """
+    Delete completed pull-queue tasks, optionally in small asynchronous
+    batches as they are completed.
+
+    :param batch_size: Flush once this many tasks are pending.
+    :param interval: Flush once this many seconds have passed since the
+        last flush.
+    :param use_async: Delete with `delete_tasks_async`.
+    :param max_pending: Maximum number of outstanding asynchronous deletes.
+    :param sink: The metrics sink to report delete timings to.
+    :param metric_prefix: Prefixed to the names of reported metrics.
+    """
+
+    def __init__(self, queue, logger, batch_size=None, interval=None,
+                 use_async=False, max_pending=1, sink=None,
+                 metric_prefix=''):
+        self.queue = queue
+        self.logger = logger
+        self.sink = sink or metrics.NullSink()
+        self.metric_prefix = metric_prefix
+        self.batch_size = batch_size
+        self.interval = interval
+        self.use_async = use_async
+        self.max_pending = max_pending
+
+        self.tasks = []
+        self.refs = []
+        self.rpcs = collections.deque()
+        self.flushed_at = time.time()
+
+    def add(self, tasks, refs=()):
+        self.tasks.extend(tasks)
+        self.refs.extend(refs)
+
+        if self.batch_size and len(self.tasks) >= self.batch_size:
+            self.flush()
+        elif (self.interval and self.tasks
+                and time.time() - self.flushed_at >= self.interval):
+            self.flush()
+
+    def flush(self):
+        tasks, self.tasks = self.tasks, []
+        refs, self.refs = self.refs, []
+        self.flushed_at = time.time()
+
+        if not tasks:
+            return
+
+        self.sink.incr(self.metric_prefix + 'deleted', len(tasks))
+        if not self.use_async:
+            with metrics.timer(self.sink, self.metric_prefix + 'delete'):
+                self.queue.delete_tasks(tasks)
+            payloads.cleanup(refs)
+            return
+
+        self.rpcs.append((self.queue.delete_tasks_async(tasks), refs))
+        while len(self.rpcs) > self.max_pending:
+            self._wait(*self.rpcs.popleft())
+
+    def wait(self):
+        """
+        Flush and wait for all outstanding deletes.
+        """
+        self.flush()
+        while self.rpcs:
+            self._wait(*self.rpcs.popleft())
+
+    def _wait(self, rpc, refs):
+        try:
+            with metrics.timer(self.sink, self.metric_prefix + 'delete'):
+                rpc.get_result()
+        except Exception:
+            self.logger.exception("Failed to delete completed tasks")
+            self.sink.incr(self.metric_prefix + 'delete_failures')
+        else:
+            payloads.cleanup(refs)
+
+
+class _LeaseSizer(object):
+    """
+    Pick lease sizes so a batch takes roughly `target_seconds` to process,
+    based on a moving average of the time taken per task.
+    """
+
+    def __init__(self, size, target_seconds=None, lease_seconds=None,
+                 min_size=1, max_size=MAX_TASKS_PER_LEASE, smoothing=0.5):
+        self.size = size
+        self.target_seconds = target_seconds
+        self.lease_seconds = lease_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.per_task = None
+
+    def record(self, tasks, seconds):
+        if not self.target_seconds or not tasks:
+            return
+
+        per_task = max(seconds / tasks, 1e-6)
+        if self.per_task is None:
+            self.per_task = per_task
+        else:
+            self.per_task = (self.smoothing * per_task +
+                             (1 - self.smoothing) * self.per_task)
+
+        size = int(self.target_seconds / self.per_task)
+        if self.lease_seconds:
+            # Never lease more than can be processed before it expires.
+            size = min(size, int(self.lease_seconds / self.per_task))
+
+        # Limit growth so a few fast tasks don't result in a huge lease.
+        size = min(size, self.size * 2)
+        self.size = max(self.min_size, min(size, self.max_size))
+
 
 class PullQueueHandler(object):
     """
@@ -153,7 +1140,9 @@ class PullQueueHandler(object):
     lease tasks until it is leased no more. At that point, the worker
     must be started again. This can be done in one of two ways:
 
-        1. Not yet implemented.
+        1. Set `autoscale_interval` and call :meth:`autoscale`. Workers
+           will be spawned in proportion to the queue's backlog, and the
+           autoscaler re-schedules itself while the queue has tasks.
 
         2. Use a cron job to call the pull worker periodically.
 
@@ -166,6 +1155,53 @@ class PullQueueHandler(object):
     :param tag: Tag tasks, and only pull matching tasks off the queue.
     :param lease_seconds: Time to lease tasks for.
     :param lease_size: Number of tasks to lease per pull.
+    :param serializer: Module or object that provides dumps/loads for
+        task payloads.
+    :param codec: A :class:`flask_gae.payloads.PayloadCodec` to compress or
+        offload large payloads with.
+    :param prefetch: Number of leases to request ahead of the batch being
+        processed. When non-zero, completed tasks are also deleted
+        asynchronously. Prefetched batches whose lease has expired by the
+        time they are reached are skipped, so keep this small relative to
+        `lease_seconds`.
+    :param delete_batch_size: If set, delete completed tasks as soon as
+        this many have been yielded, rather than at the end of the batch.
+    :param delete_interval: If set, delete completed tasks once this many
+        seconds have passed since the last delete, rather than at the end of
+        the batch. Checked whenever the worker function yields.
+    :param target_batch_seconds: If set, adjust the number of tasks leased
+        so each batch takes about this long to process. `lease_size` is then
+        the initial lease size.
+    :param extend_leases: If `True`, extend the lease on tasks that have not
+        yet been completed when a batch has used up most of `lease_seconds`.
+        Checked whenever the worker function yields.
+    :param per_item: If `True`, the worker function is called with a single
+        `(task, payload)` rather than the whole batch, on up to
+        `concurrency` threads. Tasks whose call doesn't raise (and whose
+        returned future, if any, resolves) are completed. If `'tasklets'`,
+        the function must return a future (e.g. an `ndb.tasklet`) and up to
+        `concurrency` calls are run concurrently on the worker's thread.
+    :param concurrency: The number of items to process at once when
+        `per_item` is set.
+    :param autoscale_interval: Seconds between autoscaler runs while the
+        queue has tasks. See :meth:`autoscale`.
+    :param tasks_per_worker: The backlog each worker is expected to handle
+        when autoscaling. Defaults to `lease_size`.
+    :param autoscale_queue: The push queue autoscaler tasks are added to.
+    :param start_window: If set, :meth:`start` only sends one start request
+        per module every `start_window` seconds from each instance.
+    :param metrics_sink: Where to report worker metrics. Defaults to
+        :func:`flask_gae.metrics.default_sink`.
+    :param lock: How to limit the number of concurrent workers to
+        `max_workers`. One of :data:`LOCKS`, or a lock class.
+        `'datastore'` (the default) keeps a count in a single entity.
+        `'sharded'` uses one entity per worker slot, which avoids contention
+        and frees the slot of a crashed worker after `lock_ttl` seconds.
+        `'memcache'` is `'sharded'` with a memcache fast path, so checking
+        whether all slots are taken doesn't need the datastore.
+    :param lock_ttl: Seconds a worker slot is held without being
+        refreshed. Slots are refreshed before each lease. Defaults to twice
+        `lease_seconds`.
 
     Usage ::
 
@@ -190,8 +1226,35 @@ class PullQueueHandler(object):
     serializer = pickle
 
     def __init__(self, queue_name, module_name, tag=None, lease_seconds=600,
-                 lease_size=100, max_workers=1, workers_per_spawn=1):
+                 lease_size=100, max_workers=1, workers_per_spawn=1,
+                 serializer=None, codec=None, prefetch=0,
+                 delete_batch_size=None, delete_interval=None,
+                 target_batch_seconds=None, extend_leases=False,
+                 lock='datastore', lock_ttl=None, per_item=False,
+                 concurrency=10, autoscale_interval=None,
+                 tasks_per_worker=None, autoscale_queue='default',
+                 start_window=None, metrics_sink=None):
         self.func = None
+        self.metrics_sink = metrics_sink
+        self.start_window = start_window
+        self._started = {}
+        self._started_lock = threading.Lock()
+        self.autoscale_interval = autoscale_interval
+        self.tasks_per_worker = tasks_per_worker or lease_size
+        self.autoscale_queue = autoscale_queue
+        self.per_item = per_item
+        self.concurrency = concurrency
+        self.lock_class = LOCKS.get(lock, lock)
+        self.lock_ttl = lock_ttl or lease_seconds * 2
+        self.target_batch_seconds = target_batch_seconds
+        self.extend_leases = extend_leases
+        self.codec = codec
+        self.prefetch = prefetch
+        self.delete_batch_size = delete_batch_size
+        self.delete_interval = delete_interval
+
+        if serializer is not None:
+            self.serializer = serializer
 
         self.queue_name = queue_name
         self.module_name = module_name
@@ -205,6 +1268,13 @@ class PullQueueHandler(object):
     def queue(self):
         return taskqueue.Queue(self.queue_name)
 
+    @property
+    def sink(self):
+        return self.metrics_sink or metrics.default_sink()
+
+    def _metric(self, name):
+        return 'pull.{}.{}'.format(self.__name__, name)
+
     def __call__(self, func=None):
         if self.func is None:
             self.func = func
@@ -214,88 +1284,472 @@ class PullQueueHandler(object):
         return self._start()
 
     def _start(self):
+        if 'autoscale' in flask.request.args:
+            return self._autoscale()
+
         try:
             delay = int(flask.request.args.get('delay', None))
         except (TypeError, ValueError):
             delay = None
 
-        for i in xrange(self.workers_per_spawn):
+        if delay:
+            self._schedule_start(flask.current_app, delay)
+            self.logger.debug("Delaying start by %s",
+                              timedelta(seconds=delay))
+            return "Delayed start by {} seconds".format(delay)
+
+        return self._spawn(self.workers_per_spawn)
+
+    def _spawn(self, workers):
+        for i in xrange(workers):
             start_new_background_thread(self._pull, (
-                flask.current_app._get_current_object(),
-                delay,))
+                flask.current_app._get_current_object(),))
+
+        return "Started {} workers".format(workers)
+
+    def _schedule_start(self, app, delay, module=None):
+        """
+        Start the workers `delay` seconds from now with a push task, rather
+        than holding a worker slot while waiting. Starts requested within
+        the same `delay` second window share one task.
+        """
+        self._schedule(app, 'start', countdown=delay, window=delay,
+                       target=module)
+
+    def autoscale(self, app=None):
+        """
+        Start the autoscaler for this queue. The autoscaler runs as a push
+        task on `module_name`, spawning workers up to `max_workers` in
+        proportion to the queue's backlog, and re-schedules itself every
+        `autoscale_interval` seconds until the queue is empty.
+
+        Workers exit once there are no more tasks for them to lease.
+        """
+        self._schedule(app or flask.current_app, 'autoscale', countdown=0,
+                       window=self.autoscale_interval, autoscale=1)
+
+    def _autoscale(self):
+        stats = self.queue.fetch_statistics()
+        workers = self._wanted_workers(stats)
+
+        active = self.lock_class.active_workers(
+            self.queue.name, self.max_workers)
+        spawn = max(0, workers - active)
+        self.logger.debug(
+            "Autoscaling %r: %i tasks, %i active workers, spawning %i",
+            self.queue_name, stats.tasks, active, spawn)
+
+        if stats.tasks and self.autoscale_interval:
+            # Named by the window it runs in, which is always after the
+            # window of the currently running task.
+            self._schedule(flask.current_app, 'autoscale',
+                           countdown=self.autoscale_interval,
+                           window=self.autoscale_interval, autoscale=1)
+
+        return self._spawn(spawn)
+
+    def _wanted_workers(self, stats):
+        """
+        The number of workers wanted for the queue's backlog.
+        """
+        if not stats.tasks:
+            return 0
+
+        now_usec = time.time() * 1e6
+        if stats.oldest_eta_usec and stats.oldest_eta_usec > now_usec:
+            # Nothing can be leased until the oldest task's ETA.
+            return 0
+
+        workers = -(-stats.tasks // self.tasks_per_worker)
+        return min(workers, self.max_workers)
+
+    def _schedule(self, app, kind, countdown=0, window=None, target=None,
+                  **url_args):
+        """
+        Add a push task that calls this worker's URL on `module_name`.
 
-        return "Started {} workers".format(self.workers_per_spawn)
+        When `window` is set the task is named after the target module,
+        this worker's endpoint and the window it runs in, so repeated calls
+        within the window only add one task. `window` is rounded down to
+        whole seconds.
+        """
+        target = target or self.module_name
+        name = None
+        if window:
+            window = max(int(window), 1)
+            eta = time.time() + (countdown or 0)
+            name = '-'.join([
+                self.queue_name,
+                _task_name_part(target or 'default'),
+                _task_name_part(_handler_endpoint(app, self)),
+                kind, str(window), str(int(eta // window))])
+
+        task = taskqueue.Task(
+            url=_handler_url(app, self, **url_args),
+            method='GET',
+            target=target,
+            countdown=countdown,
+            name=name)
 
-    def _pull(self, app, delay=None):
-        lock = _PullWorkerLock.acquire(self.queue.name, self.max_workers)
+        try:
+            task.add(self.autoscale_queue)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            self.logger.debug("Task %r already scheduled", name)
+
+    def _pull(self, app):
+        lock = self.lock_class.acquire(self.queue.name, self.max_workers,
+                                       ttl=self.lock_ttl)
         if lock is False:
             logging.info("Unable to acquire lock")
             return "locked"
 
-        if delay:
-            # Simple sleep delay. Much easier doing this in the lock
-            # than using a task queue or something.
-            self.logger.debug(
-                "Waiting %s before processing",
-                timedelta(seconds=delay))
-            time.sleep(delay)
+        deleter = _TaskDeleter(
+            self.queue, self.logger,
+            batch_size=self.delete_batch_size,
+            interval=self.delete_interval,
+            use_async=bool(self.prefetch or self.delete_batch_size or
+                           self.delete_interval),
+            max_pending=max(self.prefetch, 1),
+            sink=self.sink,
+            metric_prefix=self._metric(''))
+        sizer = _LeaseSizer(self.lease_size, self.target_batch_seconds,
+                            self.lease_seconds)
 
         try:
             with app.app_context():
-                while True:
-                    if self.tag:
-                        tasks = self.queue.lease_tasks_by_tag(
-                            self.lease_seconds, self.lease_size, self.tag)
+                try:
+                    if self.prefetch:
+                        self._pull_pipelined(lock, deleter, sizer)
                     else:
-                        tasks = self.queue.lease_tasks(
-                            self.lease_seconds, self.lease_size)
+                        self._pull_sequential(lock, deleter, sizer)
+                finally:
+                    deleter.wait()
+        finally:
+            lock.release()
 
-                    self.logger.debug("Leased %i tasks.", len(tasks))
-                    if len(tasks) == 0:
-                        self.logger.debug("Finishing")
-                        return
+    def _lease(self, size):
+        if self.tag:
+            return self.queue.lease_tasks_by_tag(
+                self.lease_seconds, size, self.tag)
+        return self.queue.lease_tasks(self.lease_seconds, size)
+
+    def _lease_async(self, size):
+        if self.tag:
+            return self.queue.lease_tasks_by_tag_async(
+                self.lease_seconds, size, self.tag)
+        return self.queue.lease_tasks_async(self.lease_seconds, size)
+
+    def _record_lease(self, tasks, size):
+        sink = self.sink
+        if sink.enabled:
+            sink.gauge(self._metric('batch_size'), len(tasks))
+            sink.gauge(self._metric('lease_utilization'),
+                       float(len(tasks)) / size)
+
+    def _pull_sequential(self, lock, deleter, sizer):
+        while lock.refresh():
+            leased_at = time.time()
+            with metrics.timer(self.sink, self._metric('lease')):
+                tasks = self._lease(sizer.size)
+            self._record_lease(tasks, sizer.size)
+
+            self.logger.debug("Leased %i tasks.", len(tasks))
+            if len(tasks) == 0:
+                self.logger.debug("Finishing")
+                return
+
+            self._process(tasks, lock, deleter, sizer, leased_at)
+
+    def _pull_pipelined(self, lock, deleter, sizer):
+        """
+        Keep up to `prefetch` leases in flight while processing the current
+        batch.
+        """
+        leases = collections.deque()
+        exhausted = False
+
+        while lock.refresh():
+            while not exhausted and len(leases) <= self.prefetch:
+                leases.append((time.time(), sizer.size,
+                               self._lease_async(sizer.size)))
+
+            if not leases:
+                self.logger.debug("Finishing")
+                return
+
+            leased_at, size, rpc = leases.popleft()
+            with metrics.timer(self.sink, self._metric('lease')):
+                tasks = rpc.get_result()
+            self._record_lease(tasks, size)
+
+            self.logger.debug("Leased %i tasks.", len(tasks))
+            if len(tasks) == 0:
+                exhausted = True
+                continue
+
+            if time.time() - leased_at >= self.lease_seconds:
+                # Processing these would duplicate work, as the tasks
+                # may have already been leased by another worker.
+                self.logger.warning(
+                    "Lease on %i prefetched tasks expired before "
+                    "processing.", len(tasks))
+                self.sink.incr(self._metric('expired_leases'))
+                continue
+
+            self._process(tasks, lock, deleter, sizer, leased_at)
+
+    def _process(self, tasks, lock, deleter, sizer, leased_at):
+        """
+        Run the worker function over a leased batch of tasks, passing
+        completed tasks to `deleter` as they are yielded.
+
+        `lock` is refreshed whenever leases are extended, and otherwise
+        every `lock_ttl / 2` seconds, so a long batch doesn't lose its
+        worker slot. If the lock has been lost processing stops, leaving
+        the remaining tasks to be leased again.
+        """
+        sink = self.sink
+        started = refreshed_at = time.time()
+        with metrics.timer(sink, self._metric('deserialize')):
+            output, errors, missing, refs = self._deserialize(tasks)
+        pending = collections.OrderedDict((t.name, t) for t, _ in output)
+
+        if errors:
+            sink.incr(self._metric('deserialize_failures'), len(errors))
+
+        if missing:
+            self.logger.warning(
+                "Deleting %i tasks whose payloads are missing, assuming "
+                "they have already completed", len(missing))
+            sink.incr(self._metric('missing_payloads'), len(missing))
+            deleter.add(missing)
+
+        if self.per_item == 'tasklets':
+            results = self._map_tasklets(output)
+        elif self.per_item:
+            results = self._map_threads(output)
+        else:
+            results = self.func(output)
 
-                    completed = []
-                    output, _ = self._deserialize(tasks)
+        try:
+            for success in results:
+                try:
+                    completed = list(success)
+                except TypeError:
+                    # Somebody yielded a single task.
+                    completed = [success]
+
+                for t in completed:
+                    pending.pop(t.name, None)
+                deleter.add(completed, self._completed_refs(completed, refs))
+
+                now = time.time()
+                extend = (self.extend_leases and pending and
+                          now - leased_at > self.lease_seconds * 0.75)
+                if extend or now - refreshed_at > self.lock_ttl / 2.0:
+                    if not lock.refresh():
+                        self.logger.warning(
+                            "Lost the worker lock, leaving %i tasks to "
+                            "another worker", len(pending))
+                        break
+                    refreshed_at = now
+
+                if extend:
+                    self._extend_leases(pending.values())
+                    leased_at = time.time()
+        finally:
+            deleter.flush()
+
+        elapsed = time.time() - started
+        sizer.record(len(tasks), elapsed)
+        sink.timing(self._metric('execute'), elapsed)
+        if pending:
+            sink.incr(self._metric('failures'), len(pending))
+
+    def _map_threads(self, output):
+        """
+        Call the worker function for each `(task, payload)` on a pool of
+        threads, yielding tasks as they complete successfully.
+        """
+        app = flask.current_app._get_current_object()
+        items = Queue.Queue()
+        results = Queue.Queue()
+        for item in output:
+            items.put(item)
 
+        def work():
+            with app.app_context():
+                while True:
                     try:
-                        for success in self.func(output):
-                            # Iter the function, and try to extend the
-                            # completed tasks
-                            try:
-                                completed.extend(success)
-                            except TypeError:
-                                # Somebody yielded a single task. Append it
-                                completed.append(success)
-                    finally:
-                        self.queue.delete_tasks(completed)
+                        task, payload = items.get_nowait()
+                    except Queue.Empty:
+                        return
+                    results.put((task, self._call_item(task, payload)))
 
+        threads = [threading.Thread(target=work)
+                   for _ in xrange(min(self.concurrency, len(output)))]
+        for t in threads:
+            t.start()
+
+        try:
+            for _ in xrange(len(output)):
+                task, success = results.get()
+                if success:
+                    yield task
         finally:
-            lock.release()
+            for t in threads:
+                t.join()
+
+    def _call_item(self, task, payload):
+        try:
+            resp = self.func(task, payload)
+            if hasattr(resp, 'get_result'):
+                resp.get_result()
+        except Exception:
+            self.logger.exception("Task %r failed", task.name)
+            return False
+        return True
+
+    def _map_tasklets(self, output):
+        """
+        Call the worker function for each `(task, payload)`, keeping up to
+        `concurrency` of the returned futures running at once, and yield
+        tasks as they complete successfully.
+        """
+        items = iter(output)
+        running = {}
+
+        while True:
+            for task, payload in itertools.islice(
+                    items, self.concurrency - len(running)):
+                try:
+                    running[self.func(task, payload)] = task
+                except Exception:
+                    self.logger.exception("Task %r failed", task.name)
+
+            if not running:
+                return
+
+            future = ndb.Future.wait_any(running.keys())
+            task = running.pop(future)
+            if future.get_exception() is not None:
+                self.logger.error("Task %r failed: %r", task.name,
+                                  future.get_exception())
+            else:
+                yield task
+
+    def _extend_leases(self, tasks):
+        self.logger.debug("Extending lease on %i tasks.", len(tasks))
+        for t in tasks:
+            try:
+                self.queue.modify_task_lease(t, self.lease_seconds)
+            except taskqueue.Error:
+                self.logger.warning("Unable to extend lease on %r", t.name,
+                                    exc_info=True)
 
     def _deserialize(self, tasks):
+        """
+        :returns: A tuple of `(output, errors, missing, refs)`. `missing`
+            are tasks whose offloaded payloads have already been deleted,
+            i.e. tasks that already completed.
+        """
         output = []
         errors = []
+        missing = []
+        refs = {}
         for t in tasks:
             try:
-                output.append((t, self.serializer.loads(t.payload)))
+                data, task_refs = payloads.decode(t.payload)
+                output.append((t, self.serializer.loads(data)))
+            except payloads.MissingPayloadError:
+                missing.append(t)
             except ValueError:
                 errors.append(t)
-        return output, errors
+            else:
+                if task_refs:
+                    refs[t.name] = task_refs
+        return output, errors, missing, refs
+
+    def _completed_refs(self, completed, refs):
+        """
+        Get the offloaded payload references of the completed tasks.
+        """
+        if not refs:
+            return []
+        return [ref for t in completed for ref in refs.get(t.name, ())]
+
+    def _dumps(self, payload):
+        payload = self.serializer.dumps(payload)
+        if self.codec is not None:
+            payload = self.codec.encode(payload)
+        return payload
+
+    def _make_tasks(self, payloads, task_args):
+        return [taskqueue.Task(payload=self._dumps(p),
+                               method='PULL',
+                               tag=self.tag,
+                               **task_args)
+                for p in payloads]
 
     def push(self, *payloads, **task_args):
         """
         Push data onto the queue. Each argument is pushed to the queue as a
-        new task.
+        new task. More than :data:`MAX_TASKS_PER_ADD` payloads are added in
+        concurrent chunks.
+        """
+        tasks = self._make_tasks(payloads, task_args)
+        if len(tasks) <= MAX_TASKS_PER_ADD:
+            self.queue.add(tasks)
+        else:
+            self._add_async(tasks).get_result()
+
+    def push_async(self, *payloads, **task_args):
         """
-        tasks = [taskqueue.Task(payload=self.serializer.dumps(p),
-                                method='PULL',
-                                tag=self.tag,
-                                **task_args)
-                 for p in payloads]
-        self.queue.add(tasks)
+        As :meth:`push`, but returns without waiting for the tasks to be
+        added.
 
-    def start(self, module=None, app=None, delay=None):
+        :returns: An object whose `get_result()` waits for all the chunks
+            to be added, and raises the first error if any failed.
+        """
+        return self._add_async(self._make_tasks(payloads, task_args))
+
+    def _add_async(self, tasks):
+        queue = self.queue
+        return _RPCGroup([
+            queue.add_async(tasks[i:i + MAX_TASKS_PER_ADD])
+            for i in xrange(0, len(tasks), MAX_TASKS_PER_ADD)])
+
+    def push_later(self, *payloads, **task_args):
+        """
+        Buffer data to be pushed onto the queue once the current request
+        returns a response with a status below 400, so a request pushing
+        many times only adds its tasks once. If the request fails the
+        buffered data is dropped, so a retried task does not push it twice.
+        Outside of a request the data is pushed immediately.
+        """
+        tasks = self._make_tasks(payloads, task_args)
+        if not flask.has_request_context():
+            self._add_async(tasks).get_result()
+            return
+
+        buffers = getattr(flask.g, '_flask_gae_pull_buffers', None)
+        if buffers is None:
+            buffers = flask.g._flask_gae_pull_buffers = {}
+
+        if self not in buffers:
+            buffers[self] = []
+
+            @flask.after_this_request
+            def flush(response):
+                tasks = buffers.pop(self)
+                if response.status_code < 400:
+                    self._add_async(tasks).get_result()
+                return response
+
+        buffers[self].extend(tasks)
+
+    def start(self, module=None, app=None, delay=None, wait=True):
         """
         Attempt to start processing the pull queue.
 
@@ -307,22 +1761,84 @@ class PullQueueHandler(object):
 
         :param delay: Wait x seconds before starting to pull tasks off the
             queue. Useful for preventing pulling singular tasks repeatedly.
+            Delayed starts are scheduled with a push task, and all starts
+            requested within the same `delay` second window are combined.
+
+        :param wait: If `False`, send the start request without waiting for
+            the response.
+        """
+        app = app or flask.current_app
+        if delay:
+            self._schedule_start(app, delay, module)
+            return
+
+        rpc = self.start_async(module, app)
+        if rpc is not None and wait:
+            try:
+                rpc.get_result()
+            except Exception:
+                # Let the next call try again.
+                self._mark_started(module or self.module_name, False)
+                raise
+
+    def start_async(self, module=None, app=None, deadline=None):
         """
-        with (app or flask.current_app).test_request_context():
-            path = self.url(delay=delay)
+        Asynchronously start processing the pull queue.
+
+        If `start_window` is set, and this process has already started the
+        module within the last `start_window` seconds, nothing is sent.
+
+        :param module: The module to start the task on. If unspecified
+            will default to the module_name as provided in the init method.
+
+        :param app: The flask.Flask app to build the URL off. If unspecified
+            will use the current app.
+
+        :param deadline: The urlfetch deadline.
+
+        :returns: The urlfetch RPC, or `None` if the start was skipped.
+        """
+        module = module or self.module_name
+        if not self._should_start(module):
+            self.logger.debug("Worker on %r recently started", module)
+            return None
+
+        path = _handler_url(app or flask.current_app, self)
 
         url = 'https://{module}-dot-{hostname}{path}'.format(
-            module=module or self.module_name,
+            module=module,
             hostname=app_identity.get_default_version_hostname(),
             path=path)
 
-        urlfetch.fetch(url)
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, url)
+        self._mark_started(module)
+        return rpc
+
+    def _should_start(self, module):
+        if not self.start_window:
+            return True
+
+        with self._started_lock:
+            started = self._started.get(module, 0)
+        return time.time() - started >= self.start_window
+
+    def _mark_started(self, module, started=True):
+        """
+        Record (or, if not `started`, forget) a start of `module` for
+        `start_window`.
+        """
+        if not self.start_window:
+            return
+
+        with self._started_lock:
+            if started:
+                self._started[module] = time.time()
+            else:
+                self._started.pop(module, None)
 
     def url(self, **kwargs):
-        for endpoint, function in flask.current_app.view_functions.iteritems():
-            if self is function:
-                return flask.url_for(endpoint, **kwargs)
-        raise RuntimeError("Unable to find the endpoint name")
+        return _handler_url(flask.current_app, self, **kwargs)
 
 
 pullqueue = PullQueueHandler
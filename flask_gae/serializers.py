@@ -0,0 +1,97 @@
+"""
+Serializers for task payloads.
+
+A serializer is any object providing `dumps`, `loads` and a `content_type`.
+Push-queue tasks are sent with their serializer's content type, so handlers
+can decode tasks enqueued with a different serializer (e.g. during a
+deployment that changes it).
+"""
+import json
+import cPickle as pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['PickleSerializer', 'JSONSerializer', 'MsgpackSerializer',
+           'register', 'for_content_type']
+
+
+class PickleSerializer(object):
+    """
+    Serialize with cPickle.
+
+    :param protocol: The pickle protocol. Defaults to the highest available,
+        which is considerably smaller and faster than the ASCII protocol 0.
+    """
+    content_type = 'application/x-python-pickle'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(object):
+    """
+    Serialize with JSON. Tuples will be loaded as lists.
+    """
+    content_type = 'application/json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(object):
+    """
+    Serialize with msgpack. Requires the `msgpack` package.
+    """
+    content_type = 'application/x-msgpack'
+
+    def dumps(self, obj):
+        if msgpack is None:
+            raise NotImplementedError("You need to install msgpack")
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        if msgpack is None:
+            raise NotImplementedError("You need to install msgpack")
+        return msgpack.unpackb(data, raw=False)
+
+
+#: The default serializer for push-queue payloads.
+PICKLE = PickleSerializer()
+JSON = JSONSerializer()
+MSGPACK = MsgpackSerializer()
+
+_SERIALIZERS = {}
+
+
+def register(serializer):
+    """
+    Register a serializer so payloads with its content type can be decoded.
+    """
+    _SERIALIZERS[serializer.content_type] = serializer
+    return serializer
+
+
+def for_content_type(content_type, default=PICKLE):
+    """
+    Get the registered serializer for a content type. Payloads without a
+    known content type (e.g. tasks enqueued before serializers existed) are
+    decoded with `default`.
+    """
+    return _SERIALIZERS.get(content_type, default)
+
+
+for s in (PICKLE, JSON, MSGPACK):
+    register(s)
+del s
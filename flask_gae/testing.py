@@ -4,6 +4,9 @@ try:
     import cloudstorage as gcs
 except ImportError:
     gcs = None
+    cloudstore = None
+else:
+    from . import cloudstore
 
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
@@ -53,8 +56,78 @@ class TestCase(FTTestCase):
         super(TestCase, self)._pre_setup()
 
     def _post_teardown(self):
+        if cloudstore is not None:
+            cloudstore.clear_caches()
         super(TestCase, self)._post_teardown()
 
+    @property
+    def taskqueue(self):
+        """
+        The taskqueue stub.
+        """
+        return self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def run_tasks(self, queue_names=None, recursive=True, max_rounds=100):
+        """
+        Execute pending push tasks against the test client, in ETA order.
+        Each task is removed from its queue once it has been run, whether
+        it succeeded or not.
+
+        :param queue_names: Only run tasks on these queues. Defaults to
+            all push queues.
+        :param recursive: Also run tasks added by the tasks that were run,
+            until no tasks are left.
+        :param max_rounds: When `recursive`, raise a `RuntimeError` if tasks
+            are still being added after this many rounds.
+
+        :returns: A list of `(task, response)` tuples in the order the
+            tasks were run.
+        """
+        if queue_names is None:
+            queue_names = [q['name'] for q in self.taskqueue.GetQueues()
+                           if q['mode'] != 'pull']
+
+        ran = []
+        for _ in xrange(max_rounds):
+            # Tasks from the stub don't know their queue name.
+            tasks = sorted(
+                ((task, queue_name) for queue_name in queue_names
+                 for task in self.taskqueue.get_filtered_tasks(
+                     queue_names=[queue_name])),
+                key=lambda pair: pair[0].eta_posix)
+            if not tasks:
+                return ran
+
+            for task, queue_name in tasks:
+                self.taskqueue.DeleteTask(queue_name, task.name)
+                ran.append((task, self._run_task(task, queue_name)))
+
+            if not recursive:
+                return ran
+
+        raise RuntimeError(
+            "Tasks still pending after {} rounds".format(max_rounds))
+
+    def _run_task(self, task, queue_name):
+        headers = {k: v for k, v in task.headers.iteritems()
+                   if k.lower() not in ('host', 'content-length')}
+        headers.update({
+            'X-AppEngine-QueueName': queue_name,
+            'X-AppEngine-TaskName': task.name,
+            'X-AppEngine-TaskRetryCount': str(task.retry_count or 0),
+            'X-AppEngine-TaskETA': repr(task.eta_posix),
+        })
+
+        return self.client.open(task.url, method=task.method,
+                                data=task.payload, headers=headers)
+
+    def run_pull_worker(self, handler):
+        """
+        Run a :class:`flask_gae.queuehandler.PullQueueHandler` worker on
+        the current thread until its queue is empty.
+        """
+        return handler._pull(self.app)
+
     def create_gcs_file(self, filename, data='', bucket=None,
                         mimetype=None):
         bucket = bucket or app_identity.get_default_gcs_bucket_name()
@@ -1,8 +1,12 @@
 import mock
 import flask
+import datetime
 
 import cloudstorage as gcs
+from google.appengine.api import memcache
+from google.appengine.ext import blobstore
 from flask.ext import gae
+from flask_gae import cloudstore
 
 
 class SendGCSTestCase(gae.testing.TestCase):
@@ -19,7 +23,9 @@ class SendGCSTestCase(gae.testing.TestCase):
                 add_last_modified=('nolastmod' not in flask.request.args),
                 as_attachment=('attachment' in flask.request.args),
                 attachment_filename=flask.request.args.get(
-                    'attachment_filename', None))
+                    'attachment_filename', None),
+                stat_cache_ttl=flask.request.args.get(
+                    'ttl', None, type=int))
 
         return app
 
@@ -79,9 +85,292 @@ class SendGCSTestCase(gae.testing.TestCase):
         self.assertEqual(resp1.headers['Content-Disposition'],
                          "attachment; filename=wizboingbounce")
 
-    @mock.patch.object(gcs, 'stat', wraps=gcs.stat)
-    def test_no_stat_call(self, gcs_stat):
+    @mock.patch.object(cloudstore, 'stat_async',
+                       wraps=cloudstore.stat_async)
+    def test_no_stat_call(self, stat_async):
         self.client.get(
             '/file-missing?mimetype=text/plain&noetag=1&nolastmod=1')
-        self.assertFalse(gcs_stat.called)
+        self.assertFalse(stat_async.called)
 
+    @mock.patch.object(cloudstore.blobstore, 'create_gs_key_async',
+                       wraps=cloudstore.blobstore.create_gs_key_async)
+    def test_not_modified(self, create_gs_key_async):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+        etag = self.client.get('/test.txt').get_etag()[0]
+        cloudstore.clear_caches()
+        create_gs_key_async.reset_mock()
+
+        resp = self.client.get('/test.txt',
+                               headers={'If-None-Match': '"%s"' % etag})
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.get_etag()[0], etag)
+        self.assertFalse(create_gs_key_async.called)
+
+        future = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        resp = self.client.get('/test.txt', headers={
+            'If-Modified-Since': future.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+        self.assertStatus(resp, 304)
+        self.assertFalse(create_gs_key_async.called)
+
+    def test_modified(self):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        resp = self.client.get('/test.txt',
+                               headers={'If-None-Match': '"other"'})
+        self.assert200(resp)
+        self.assertBlobkey(resp, filename='/test.txt')
+
+        # Without etags or last modified there is nothing to compare.
+        resp = self.client.get('/test.txt?noetag=1&nolastmod=1',
+                               headers={'If-None-Match': '"other"'})
+        self.assert200(resp)
+        self.assertBlobkey(resp, filename='/test.txt')
+
+    def test_range(self):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+        etag = self.client.get('/test.txt').get_etag()[0]
+
+        resp = self.client.get('/test.txt', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(resp.headers[blobstore.BLOB_RANGE_HEADER],
+                         'bytes=0-9')
+
+        resp = self.client.get('/test.txt', headers={
+            'Range': 'bytes=0-9', 'If-Range': '"%s"' % etag})
+        self.assertEqual(resp.headers[blobstore.BLOB_RANGE_HEADER],
+                         'bytes=0-9')
+
+        # Serve the whole file if it changed
+        resp = self.client.get('/test.txt', headers={
+            'Range': 'bytes=0-9', 'If-Range': '"other"'})
+        self.assertNotIn(blobstore.BLOB_RANGE_HEADER, resp.headers)
+
+        # Multiple ranges are unsupported
+        resp = self.client.get('/test.txt',
+                               headers={'Range': 'bytes=0-9,20-29'})
+        self.assertNotIn(blobstore.BLOB_RANGE_HEADER, resp.headers)
+
+    @mock.patch.object(cloudstore.blobstore, 'create_gs_key_async',
+                       wraps=cloudstore.blobstore.create_gs_key_async)
+    def test_blobkey_cache(self, create_gs_key_async):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        resp1 = self.client.get('/test.txt')
+        resp2 = self.client.get('/test.txt')
+        self.assertBlobkey(resp1, filename='/test.txt')
+        self.assertBlobkey(resp2, filename='/test.txt')
+        self.assertEqual(create_gs_key_async.call_count, 1)
+
+        stats = cloudstore.cache_stats()['blobkey']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']),
+                         (1, 1, 1))
+
+    @mock.patch.object(cloudstore.blobstore, 'create_gs_key_async',
+                       wraps=cloudstore.blobstore.create_gs_key_async)
+    def test_blobkey_memcache(self, create_gs_key_async):
+        self.app.config['GAE_GCS_BLOBKEY_MEMCACHE'] = True
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        self.client.get('/test.txt')
+        cloudstore.clear_caches()
+        resp = self.client.get('/test.txt')
+        self.assertBlobkey(resp, filename='/test.txt')
+        self.assertEqual(create_gs_key_async.call_count, 1)
+
+    @mock.patch.object(cloudstore.blobstore, 'create_gs_key_async',
+                       wraps=cloudstore.blobstore.create_gs_key_async)
+    def test_blobkey_cache_disabled(self, create_gs_key_async):
+        cloudstore.set_blobkey_cache_size(0)
+        self.addCleanup(cloudstore.set_blobkey_cache_size, 1000)
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        self.client.get('/test.txt')
+        self.client.get('/test.txt')
+        self.assertEqual(create_gs_key_async.call_count, 2)
+        self.assertEqual(cloudstore.cache_stats()['blobkey']['size'], 0)
+
+    def test_stat_async(self):
+        self.create_gcs_file('/test.txt', data='data', mimetype='text/plain')
+        filename = '/{}/test.txt'.format(cloudstore._default_bucket())
+
+        stat = cloudstore.stat_async(filename).get_result()
+        expected = gcs.stat(filename)
+        self.assertEqual(
+            (stat.content_type, stat.etag, stat.st_size, stat.st_ctime),
+            (expected.content_type, expected.etag, expected.st_size,
+             expected.st_ctime))
+
+        with self.assertRaises(gcs.NotFoundError):
+            cloudstore.stat_async('/bucket/missing').get_result()
+
+    @mock.patch.object(cloudstore, 'stat_async',
+                       wraps=cloudstore.stat_async)
+    def test_stat_cache(self, stat_async):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        resp1 = self.client.get('/test.txt?ttl=60')
+        resp2 = self.client.get('/test.txt?ttl=60')
+        self.assertEqual(stat_async.call_count, 1)
+        self.assertEqual(resp2.mimetype, 'text/plain')
+        self.assertEqual(resp1.get_etag(), resp2.get_etag())
+
+        # Served from memcache once local memory is cleared
+        cloudstore.clear_caches()
+        self.client.get('/test.txt?ttl=60')
+        self.assertEqual(stat_async.call_count, 1)
+
+        gae.invalidate_gcs_file('/test.txt')
+        self.client.get('/test.txt?ttl=60')
+        self.assertEqual(stat_async.call_count, 2)
+
+    @mock.patch.object(cloudstore, 'stat_async',
+                       wraps=cloudstore.stat_async)
+    def test_stat_cache_disabled(self, stat_async):
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        self.client.get('/test.txt')
+        self.client.get('/test.txt')
+        self.assertEqual(stat_async.call_count, 2)
+
+    def test_stat_cache_config(self):
+        self.app.config['GAE_GCS_STAT_CACHE_TTL'] = 60
+        self.create_gcs_file('/test.txt', mimetype='text/plain')
+
+        self.client.get('/test.txt')
+        self.assertEqual(len(cloudstore._stat_cache), 1)
+
+        gae.invalidate_gcs_file('/test.txt')
+        self.assertEqual(len(cloudstore._stat_cache), 0)
+
+    @mock.patch.object(cloudstore, 'stat_async',
+                       wraps=cloudstore.stat_async)
+    def test_stat_cache_not_found(self, stat_async):
+        self.assert404(self.client.get('/file-missing?ttl=60'))
+        self.assert404(self.client.get('/file-missing?ttl=60'))
+        self.assertEqual(stat_async.call_count, 1)
+
+        # Created files are only found after invalidating the cache.
+        self.create_gcs_file('/file-missing', mimetype='text/plain')
+        self.assert404(self.client.get('/file-missing?ttl=60'))
+
+        gae.invalidate_gcs_file('/file-missing')
+        self.assert200(self.client.get('/file-missing?ttl=60'))
+
+    def test_stat_cache_long_filename(self):
+        key = cloudstore._memcache_key(cloudstore.STAT_CACHE_PREFIX,
+                                       '/bucket/' + 'a' * 1000)
+        self.assertLessEqual(len(key), memcache.MAX_KEY_SIZE)
+
+
+class CachePolicyTestCase(gae.testing.TestCase):
+    def create_app(self):
+        return flask.Flask(__name__)
+
+    def send(self, filename, **kwargs):
+        self.create_gcs_file(filename, mimetype='text/plain')
+        with self.app.test_request_context(filename):
+            return gae.send_gcs_file(filename, **kwargs)
+
+    def test_default(self):
+        resp = self.send('/test.txt')
+        self.assertEqual(resp.headers['Cache-Control'], 'public')
+
+    def test_policy(self):
+        resp = self.send('/test.txt', cache_policy=gae.CachePolicy(
+            max_age=60, s_maxage=3600, stale_while_revalidate=30,
+            stale_if_error=600, vary=['Accept-Encoding']))
+
+        directives = sorted(
+            d.strip() for d in resp.headers['Cache-Control'].split(','))
+        self.assertEqual(directives, [
+            'max-age=60', 'public', 's-maxage=3600', 'stale-if-error=600',
+            'stale-while-revalidate=30'])
+        self.assertIn('Accept-Encoding', resp.vary)
+
+    def test_private(self):
+        resp = self.send('/test.txt', cache_policy={'public': False})
+        self.assertEqual(resp.headers['Cache-Control'], 'private')
+
+    def test_hashed_filename(self):
+        policy = gae.CachePolicy(max_age=60, hashed_max_age=31536000)
+
+        resp = self.send('/app.3f2a9c1b7e.js', cache_policy=policy)
+        self.assertEqual(resp.cache_control.max_age, 31536000)
+        self.assertIn('immutable', resp.cache_control)
+
+        for filename in ('/app.js', '/report-20240101.pdf',
+                         '/invoice-00012345.pdf', '/app.3f2a9c1b.js'):
+            resp = self.send(filename, cache_policy=policy)
+            self.assertEqual(resp.cache_control.max_age, 60)
+            self.assertNotIn('immutable', resp.cache_control)
+
+    def test_hashed_pattern(self):
+        policy = gae.CachePolicy(max_age=60, hashed_max_age=31536000,
+                                 hashed_pattern=r'\.[0-9a-f]{8}\.js$')
+
+        resp = self.send('/app.3f2a9c1b.js', cache_policy=policy)
+        self.assertEqual(resp.cache_control.max_age, 31536000)
+
+    def test_config(self):
+        self.app.config['GAE_GCS_CACHE_POLICY'] = {'max_age': 60}
+        self.app.config['GAE_GCS_CACHE_RULES'] = [
+            ('/static/', gae.CachePolicy(max_age=3600)),
+            ('/static/images/', {'max_age': 86400, 'immutable': True}),
+        ]
+
+        self.assertEqual(
+            self.send('/test.txt').cache_control.max_age, 60)
+        self.assertEqual(
+            self.send('/static/app.js').cache_control.max_age, 3600)
+
+        resp = self.send('/static/images/logo.png')
+        self.assertEqual(resp.cache_control.max_age, 86400)
+        self.assertIn('immutable', resp.cache_control)
+
+        # Per call policies take precedence
+        resp = self.send('/static/app.js', cache_policy={'max_age': 5})
+        self.assertEqual(resp.cache_control.max_age, 5)
+
+    def test_not_modified(self):
+        etag = self.send('/test.txt').get_etag()[0]
+        with self.app.test_request_context(
+                '/test.txt', headers={'If-None-Match': '"%s"' % etag}):
+            resp = gae.send_gcs_file(
+                '/test.txt', cache_policy={'max_age': 60})
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.cache_control.max_age, 60)
+
+
+class LRUCacheTestCase(gae.testing.TestCase):
+    def create_app(self):
+        return flask.Flask(__name__)
+
+    def test_eviction(self):
+        cache = cloudstore._LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1,
+                                         'size': 2, 'max_size': 2})
+
+        # Shrinking evicts the least recently used entries
+        cache.resize(1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 3)
+
+    @mock.patch('time.time')
+    def test_expiry(self, time):
+        cache = cloudstore._LRUCache()
+        time.return_value = 100
+        cache.set('a', 1, ttl=10)
+        self.assertEqual(cache.get('a'), 1)
+
+        time.return_value = 110
+        self.assertIsNone(cache.get('a'))
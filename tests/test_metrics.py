@@ -0,0 +1,71 @@
+import socket
+import unittest
+
+import mock
+
+from flask.ext.gae import metrics
+
+
+class MemorySinkTestCase(unittest.TestCase):
+    def test_aggregates(self):
+        sink = metrics.MemorySink()
+        sink.timing('t', 1.0)
+        sink.timing('t', 3.0)
+        sink.incr('c')
+        sink.incr('c', 2)
+        sink.gauge('g', 5)
+        sink.gauge('g', 6)
+
+        self.assertEqual(sink.snapshot(), {
+            'timings': {'t': {'count': 2, 'total': 4.0,
+                              'min': 1.0, 'max': 3.0}},
+            'counters': {'c': 3},
+            'gauges': {'g': 6},
+        })
+
+        sink.reset()
+        self.assertEqual(sink.snapshot()['counters'], {})
+
+    def test_timer(self):
+        sink = metrics.MemorySink()
+        with metrics.timer(sink, 'block'):
+            pass
+        self.assertEqual(sink.snapshot()['timings']['block']['count'], 1)
+
+    def test_null_timer(self):
+        sink = mock.Mock(enabled=False)
+        with metrics.timer(sink, 'block'):
+            pass
+        self.assertFalse(sink.timing.called)
+
+
+class StatsdSinkTestCase(unittest.TestCase):
+    @mock.patch.object(socket, 'socket')
+    def test_send(self, sock):
+        sink = metrics.StatsdSink('statsd', 1234, prefix='app.')
+        sink.timing('t', 0.5)
+        sink.incr('c', 2)
+        sink.gauge('g', 3)
+
+        self.assertEqual(sock().sendto.call_args_list, [
+            mock.call('app.t:500.000|ms', ('statsd', 1234)),
+            mock.call('app.c:2|c', ('statsd', 1234)),
+            mock.call('app.g:3|g', ('statsd', 1234)),
+        ])
+
+    @mock.patch.object(socket, 'socket')
+    def test_send_error(self, sock):
+        sock().sendto.side_effect = socket.error()
+        metrics.StatsdSink().incr('c')
+
+
+class DefaultSinkTestCase(unittest.TestCase):
+    def tearDown(self):
+        metrics.set_default_sink(None)
+
+    def test_default(self):
+        self.assertFalse(metrics.default_sink().enabled)
+
+        sink = metrics.MemorySink()
+        metrics.set_default_sink(sink)
+        self.assertIs(metrics.default_sink(), sink)
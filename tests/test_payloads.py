@@ -0,0 +1,57 @@
+from flask.ext import gae
+from flask.ext.gae import payloads
+
+
+class PayloadCodecTestCase(gae.testing.TestCase):
+    def create_app(self):
+        import flask
+        return flask.Flask(__name__)
+
+    def test_small_payload(self):
+        codec = payloads.PayloadCodec()
+        self.assertEqual(codec.encode('small'), 'small')
+        self.assertEqual(payloads.decode('small'), ('small', []))
+
+    def test_compress(self):
+        codec = payloads.PayloadCodec(compress_threshold=10)
+        data = 'a' * 1000
+
+        encoded = codec.encode(data)
+        self.assertTrue(encoded.startswith(payloads.MAGIC + 'zlib:'))
+        self.assertLess(len(encoded), len(data))
+        self.assertEqual(payloads.decode(encoded), (data, []))
+
+    def test_offload(self):
+        codec = payloads.PayloadCodec(compress_threshold=None,
+                                      offload_threshold=10)
+        data = 'a' * 1000
+
+        encoded = codec.encode(data)
+        self.assertTrue(encoded.startswith(payloads.MAGIC + 'datastore:'))
+
+        decoded, refs = payloads.decode(encoded)
+        self.assertEqual(decoded, data)
+        self.assertEqual(len(refs), 1)
+
+        payloads.cleanup(refs)
+        with self.assertRaises(payloads.MissingPayloadError):
+            payloads.decode(encoded)
+
+    def test_compress_and_offload(self):
+        codec = payloads.PayloadCodec(compress_threshold=10,
+                                      offload_threshold=10)
+        data = ''.join(chr(i % 256) for i in xrange(1000))
+
+        encoded = codec.encode(data)
+        self.assertTrue(
+            encoded.startswith(payloads.MAGIC + 'zlib,datastore:'))
+        self.assertEqual(payloads.decode(encoded)[0], data)
+
+    def test_corrupt(self):
+        with self.assertRaises(ValueError):
+            payloads.decode(payloads.MAGIC + 'zlib:not compressed')
+
+    def test_unknown_store(self):
+        with self.assertRaises(ValueError) as ctx:
+            payloads.decode(payloads.MAGIC + 'unknown:ref')
+        self.assertNotIsInstance(ctx.exception, payloads.MissingPayloadError)
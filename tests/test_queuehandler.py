@@ -1,11 +1,22 @@
 import os
+import json
+import time
+import datetime
+import itertools
+import threading
 import cPickle as pickle
 import mock
 import flask
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import modules
+from google.appengine.api import urlfetch
 from google.appengine.api import taskqueue
 
 from flask.ext import gae
 from flask.ext.gae import queuehandler
+from flask.ext.gae import payloads
+from flask.ext.gae import serializers
 
 
 @gae.pushqueue('testqueue')
@@ -25,14 +36,39 @@ ROW_WORKER = mock.MagicMock()
 
 
 @tq_bp.route('/worker')
-@gae.pullqueue('pullqueue', 'module', 123, 50)
+@gae.pullqueue('pullqueue', 'module', lease_seconds=123, lease_size=50)
 def worker(rows):
     for task, data in rows:
         ROW_WORKER(data)
         yield task
 
 
+ITEM_WORKER = mock.MagicMock()
+
+
+@tq_bp.route('/item-worker')
+@gae.pullqueue('pullqueue', 'module', lease_seconds=123, lease_size=50,
+               per_item=True, concurrency=4)
+def item_worker(task, data):
+    ITEM_WORKER(data)
+    if data % 10 == 0:
+        raise ValueError(data)
+
+
+@tq_bp.route('/tasklet-worker')
+@gae.pullqueue('pullqueue', 'module', lease_seconds=123, lease_size=50,
+               per_item='tasklets', concurrency=4)
+@ndb.tasklet
+def tasklet_worker(task, data):
+    yield ndb.sleep(0)
+    ITEM_WORKER(data)
+    if data % 10 == 0:
+        raise ValueError(data)
+
+
 class PushQueueViewTestCase(gae.testing.TestCase):
+    taskqueue_stub = {'root_path': os.path.dirname(__file__)}
+
     def setUp(self):
         execute_patch = mock.patch.object(execute, 'func')
         self.addCleanup(execute_patch.stop)
@@ -48,16 +84,53 @@ class PushQueueViewTestCase(gae.testing.TestCase):
             view_func=execute)
 
         app.register_blueprint(tq_bp, url_prefix='/bp')
+        app.register_blueprint(gae.deadletters, url_prefix='/deadletters')
 
         return app
 
     def make_request(self, *args, **kwargs):
+        retries = kwargs.pop('_retries', 1)
         payload = pickle.dumps((args, kwargs))
         return self.client.post('/testhandler/', data=payload, headers={
             'X-AppEngine-QueueName': 'test',
-            'X-AppEngine-TaskRetryCount': 1,
+            'X-AppEngine-TaskRetryCount': retries,
         })
 
+    def test_run_tasks(self):
+        self.view.queue(1, 2, kw='arg')
+        self.view.queue(3, _eta=datetime.datetime.utcnow() -
+                        datetime.timedelta(seconds=60))
+
+        [(task1, resp1), (task2, resp2)] = self.run_tasks()
+        self.assert200(resp1)
+        self.assert200(resp2)
+
+        # Run in ETA order
+        self.assertEqual(self.execute.call_args_list,
+                         [mock.call(3), mock.call(1, 2, kw='arg')])
+        self.assertEqual(self.run_tasks(), [])
+
+    def test_run_tasks_headers(self):
+        self.execute.side_effect = lambda: self.assertEqual(
+            flask.request.headers['X-AppEngine-QueueName'], 'testqueue')
+        self.view.queue()
+
+        [(task, resp)] = self.run_tasks()
+        self.assert200(resp)
+        self.assertEqual(self.execute.call_count, 1)
+
+    def test_run_tasks_recursive(self):
+        def requeue(n):
+            if n:
+                self.view.queue(n - 1)
+        self.execute.side_effect = requeue
+
+        self.view.queue(3)
+        self.assertEqual(len(self.run_tasks()), 4)
+
+        self.view.queue(3)
+        self.assertEqual(len(self.run_tasks(recursive=False)), 1)
+
     def test_no_queueheaders(self):
         resp = self.client.post('/testhandler/', data="")
         self.assert403(resp)
@@ -86,6 +159,169 @@ class PushQueueViewTestCase(gae.testing.TestCase):
         # Check the future result is retreived
         self.execute().get_result.assert_called_once_with()
 
+    def test_content_type(self):
+        """
+        Payloads are decoded with the serializer matching their content type
+        """
+        resp = self.client.post(
+            '/testhandler/',
+            data=serializers.JSON.dumps(((1, 2), {'kw': 'arg'})),
+            headers={
+                'X-AppEngine-QueueName': 'test',
+                'Content-Type': 'application/json',
+            })
+        self.assert200(resp)
+        self.execute.assert_called_once_with(1, 2, kw='arg')
+
+    @mock.patch('google.appengine.api.taskqueue.add')
+    def test_queue_serializer(self, tq_add):
+        with mock.patch.object(self.view, 'serializer', serializers.JSON):
+            self.view.queue(1, kw='arg')
+
+        self.assertEqual(
+            tq_add.call_args[1]['headers'],
+            {'Content-Type': 'application/json'})
+        self.assertEqual(
+            json.loads(tq_add.call_args[1]['payload']),
+            [[1], {'kw': 'arg'}])
+
+    def test_max_attempts(self):
+        self.execute.side_effect = NotImplementedError()
+
+        with mock.patch.object(self.view, 'max_attempts', 3):
+            resp = self.make_request(1, _retries=1)
+            self.assertEqual(resp.status_code, 500)
+            self.assertEqual(queuehandler._DeadTask.query().count(), 0)
+
+            # Third attempt
+            resp = self.make_request(1, _retries=2)
+            self.assert200(resp)
+
+        [dead] = queuehandler._DeadTask.query().fetch()
+        self.assertEqual(dead.url, '/testhandler/')
+        self.assertEqual(dead.queue_name, 'test')
+        self.assertEqual(dead.attempts, 3)
+        self.assertEqual(pickle.loads(dead.payload), ((1,), {}))
+        self.assertIn('NotImplementedError', dead.error)
+        self.assertEqual(dead.module, modules.get_current_module_name())
+        self.assertEqual(dead.version, modules.get_current_version_name())
+
+    def test_dead_letter_queue(self):
+        self.execute.side_effect = NotImplementedError()
+
+        with mock.patch.multiple(self.view, max_attempts=1,
+                                 dead_letter_queue='deadletters'):
+            self.assert200(self.make_request(1, _retries=0))
+
+        self.assertEqual(queuehandler._DeadTask.query().count(), 0)
+        [task] = taskqueue.Queue('deadletters').lease_tasks_by_tag(
+            60, 10, 'test')
+        self.assertEqual(pickle.loads(task.payload)['url'], '/testhandler/')
+
+    def test_replay_dead_tasks(self):
+        queuehandler._DeadTask(
+            url='/testhandler/', queue_name='testqueue',
+            payload=pickle.dumps(((1,), {}))).put()
+
+        self.login_appengine_user('admin@example.com', 'admin', True)
+        resp = self.client.post('/deadletters/replay')
+        self.assertEqual(resp.data, "Replayed 1 tasks")
+
+        self.assertEqual(queuehandler._DeadTask.query().count(), 0)
+        stub = self.testbed.get_stub('taskqueue')
+        [task] = stub.get_filtered_tasks(queue_names=['testqueue'])
+        self.assertEqual(task.url, '/testhandler/')
+
+    @mock.patch('google.appengine.api.taskqueue.Queue.add')
+    def test_replay_dead_tasks_target(self, queue_add):
+        queuehandler._DeadTask(
+            url='/testhandler/', queue_name='testqueue', module='worker',
+            version='v2', payload=pickle.dumps(((1,), {}))).put()
+
+        queuehandler.replay_dead_tasks()
+        [[task]] = queue_add.call_args[0]
+        self.assertEqual(task.target, 'v2.worker')
+
+    def test_replay_dead_letter_queue_limit(self):
+        taskqueue.Queue('deadletters').add(taskqueue.Task(
+            payload=pickle.dumps({'url': '/testhandler/',
+                                  'queue_name': 'testqueue'}),
+            method='PULL'))
+
+        self.login_appengine_user('admin@example.com', 'admin', True)
+        resp = self.client.post('/deadletters/replay', data={
+            'limit': 5000, 'dead_letter_queue': 'deadletters'})
+        self.assertEqual(resp.data, "Replayed 1 tasks")
+
+        self.assert400(self.client.post('/deadletters/replay',
+                                        data={'limit': 0}))
+
+    def test_replay_requires_admin(self):
+        self.assert403(self.client.post('/deadletters/replay'))
+
+    @mock.patch('google.appengine.api.taskqueue.add')
+    def test_queue_retry_options(self, tq_add):
+        options = taskqueue.TaskRetryOptions(min_backoff_seconds=1)
+        with mock.patch.object(self.view, 'retry_options', options):
+            self.view.queue(1)
+
+        self.assertIs(tq_add.call_args[1]['retry_options'], options)
+
+    def test_metrics(self):
+        sink = gae.metrics.MemorySink()
+        self.execute.return_value = mock.Mock(['get_result'])
+
+        with mock.patch.object(self.view, 'metrics_sink', sink):
+            self.client.post(
+                '/testhandler/',
+                data=pickle.dumps(((1,), {})),
+                headers={'X-AppEngine-QueueName': 'test',
+                         'X-AppEngine-TaskETA': repr(time.time() - 5)})
+
+            self.execute.side_effect = NotImplementedError()
+            self.make_request(1)
+
+        snapshot = sink.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'push.execute.successes': 1,
+            'push.execute.failures': 1,
+        })
+        self.assertEqual(
+            sorted(snapshot['timings']),
+            ['push.execute.deserialize', 'push.execute.execute',
+             'push.execute.future', 'push.execute.queue_delay'])
+        self.assertGreaterEqual(
+            snapshot['timings']['push.execute.queue_delay']['min'], 5)
+
+    def test_encoded_payload(self):
+        """
+        Offloaded payloads are rehydrated and cleaned up after success
+        """
+        codec = payloads.PayloadCodec(offload_threshold=0)
+        data = codec.encode(pickle.dumps(((1, 2), {'kw': 'arg'})))
+
+        with mock.patch.object(payloads, 'cleanup') as cleanup:
+            resp = self.client.post('/testhandler/', data=data, headers={
+                'X-AppEngine-QueueName': 'test'})
+
+        self.assert200(resp)
+        self.execute.assert_called_once_with(1, 2, kw='arg')
+        [[(store, ref)]] = cleanup.call_args[0]
+        self.assertEqual(store.name, 'datastore')
+
+    def test_missing_payload(self):
+        """
+        Redelivered tasks whose payloads were cleaned up are acknowledged
+        """
+        codec = payloads.PayloadCodec(offload_threshold=0)
+        data = codec.encode(pickle.dumps(((1,), {})))
+        payloads.cleanup(payloads.decode(data)[1])
+
+        resp = self.client.post('/testhandler/', data=data, headers={
+            'X-AppEngine-QueueName': 'test'})
+        self.assert200(resp)
+        self.assertFalse(self.execute.called)
+
     def test_failure(self):
         """
         When a call to execute() fails, make sure we log an exception and
@@ -98,18 +334,20 @@ class PushQueueViewTestCase(gae.testing.TestCase):
 
     @mock.patch('google.appengine.api.taskqueue.add')
     def test_queue(self, tq_add):
-        payload = pickle.dumps(((1, 2, 3), {'kw': 'arg'}))
         self.view.queue(1, 2, 3, kw='arg')
 
         tq_add.assert_called_once_with(
             url='/testhandler/',
             queue_name='testqueue',
-            payload=payload,
+            payload=mock.ANY,
+            headers={'Content-Type': 'application/x-python-pickle'},
             transactional=None,
             eta=None,
             target=None,
             name=None,
         )
+        self.assertEqual(pickle.loads(tq_add.call_args[1]['payload']),
+                         ((1, 2, 3), {'kw': 'arg'}))
 
     @mock.patch('google.appengine.api.taskqueue.add')
     def test_queue_extra_args(self, tq_add):
@@ -123,6 +361,7 @@ class PushQueueViewTestCase(gae.testing.TestCase):
             url='/testhandler/',
             queue_name='testqueue',
             payload=mock.ANY,
+            headers=mock.ANY,
             transactional=mock.sentinel.TRANSACTIONAL,
             eta=mock.sentinel.ETA,
             target=mock.sentinel.TARGET,
@@ -140,6 +379,7 @@ class PushQueueViewTestCase(gae.testing.TestCase):
             url='/bp/queue/',
             queue_name='testqueue',
             payload=mock.ANY,
+            headers=mock.ANY,
             transactional=None,
             eta=None,
             target=None,
@@ -160,12 +400,314 @@ class PushQueueViewTestCase(gae.testing.TestCase):
             url='/foo/bar/baz/',
             queue_name='other_queue',
             payload=mock.ANY,
+            headers=mock.ANY,
             transactional=None,
             eta=None,
             target=None,
             name=None,
         )
 
+    def test_url_cache(self):
+        """
+        Endpoint lookups are cached, but re-registering the handler under a
+        different endpoint is picked up.
+        """
+        self.assertEqual(self.view.url(), '/testhandler/')
+
+        del self.app.view_functions['execute']
+        self.app.add_url_rule('/moved/', 'moved', view_func=execute)
+        self.assertEqual(self.view.url(), '/moved/')
+
+    def test_queue_current_app(self):
+        """
+        Queueing without `_app` uses (and caches) the current app.
+        """
+        self.view.queue(1)
+
+        stub = self.testbed.get_stub('taskqueue')
+        [task] = stub.get_filtered_tasks(queue_names=['testqueue'])
+        self.assertEqual(task.url, '/testhandler/')
+        self.assertEqual(queuehandler._ENDPOINTS[self.app],
+                         {execute: 'execute'})
+
+    @mock.patch.object(taskqueue.Queue, 'add')
+    def test_queue_many(self, queue_add):
+        """
+        Calls are added in chunks of MAX_TASKS_PER_ADD
+        """
+        self.view.queue_many(((i,), {'kw': 'arg'}) for i in xrange(250))
+
+        self.assertEqual(
+            [len(c[0][0]) for c in queue_add.call_args_list],
+            [100, 100, 50])
+
+        task = queue_add.call_args_list[0][0][0][0]
+        self.assertEqual(task.url, '/testhandler/')
+        self.assertEqual(pickle.loads(task.payload), ((0,), {'kw': 'arg'}))
+
+    @mock.patch.object(taskqueue.Queue, 'add_async')
+    def test_batch_async(self, add_async):
+        with self.view.batch(use_async=True) as batch:
+            for i in xrange(150):
+                batch.queue(i, _name='task-{}'.format(i))
+
+        self.assertEqual(add_async.call_count, 2)
+        self.assertEqual(add_async.return_value.get_result.call_count, 2)
+
+    @mock.patch.object(taskqueue.Queue, 'add')
+    def test_batch_errors(self, queue_add):
+        error = taskqueue.TransientError()
+        queue_add.side_effect = [None, error, None]
+
+        with self.assertRaises(queuehandler.BatchEnqueueError) as ctx:
+            self.view.queue_many(((i,), {}) for i in xrange(250))
+
+        # All chunks are attempted, only the failed one is reported
+        self.assertEqual(queue_add.call_count, 3)
+        [(tasks, exception)] = ctx.exception.failures
+        self.assertEqual(len(tasks), 100)
+        self.assertIs(exception, error)
+
+    def test_batch_transactional(self):
+        def add(count):
+            with self.view.batch(transactional=True) as batch:
+                for i in xrange(count):
+                    batch.queue(i)
+
+        ndb.transaction(lambda: add(queuehandler.MAX_TRANSACTIONAL_TASKS))
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(
+            len(stub.get_filtered_tasks(queue_names=['testqueue'])), 5)
+
+        with self.assertRaises(taskqueue.TooManyTasksError):
+            ndb.transaction(
+                lambda: add(queuehandler.MAX_TRANSACTIONAL_TASKS + 1))
+
+    def test_dedupe(self):
+        with mock.patch.multiple(self.view, dedupe=lambda a, **kw: a,
+                                 _seen={}), \
+                mock.patch('google.appengine.api.taskqueue.add') as tq_add:
+            self.view.queue(1, kw='arg')
+            self.view.queue(1, kw='other')
+            self.view.queue(2)
+
+        # Duplicates are collapsed before any RPC
+        self.assertEqual(tq_add.call_count, 2)
+        names = [c[1]['name'] for c in tq_add.call_args_list]
+        self.assertEqual(len(set(names)), 2)
+        self.assertTrue(all(n.startswith('dedupe-') for n in names))
+
+    def test_dedupe_failed_add(self):
+        """
+        Calls whose add failed can be retried in the same window
+        """
+        with mock.patch.multiple(self.view, dedupe=lambda a: a, _seen={}), \
+                mock.patch('google.appengine.api.taskqueue.add') as tq_add:
+            tq_add.side_effect = taskqueue.TransientError()
+            with self.assertRaises(taskqueue.TransientError):
+                self.view.queue(1)
+
+            tq_add.side_effect = None
+            self.view.queue(1)
+
+        self.assertEqual(tq_add.call_count, 2)
+
+    @mock.patch.object(taskqueue.Queue, 'add')
+    def test_dedupe_failed_batch(self, queue_add):
+        queue_add.side_effect = [taskqueue.TransientError(), None]
+
+        with mock.patch.multiple(self.view, dedupe=lambda a: a, _seen={}):
+            with self.assertRaises(queuehandler.BatchEnqueueError):
+                self.view.queue_many([((1,), {})])
+            self.view.queue_many([((1,), {})])
+
+        self.assertEqual(queue_add.call_count, 2)
+
+    def test_dedupe_existing_task(self):
+        """
+        Tasks already queued by other instances are ignored
+        """
+        with mock.patch.multiple(self.view, dedupe=lambda a: a, _seen={}):
+            self.view.queue(1)
+            self.view._seen.clear()
+            self.view.queue(1)
+
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(
+            len(stub.get_filtered_tasks(queue_names=['testqueue'])), 1)
+
+    def test_dedupe_named(self):
+        with mock.patch.multiple(self.view, dedupe=lambda a: a, _seen={}), \
+                mock.patch('google.appengine.api.taskqueue.add') as tq_add:
+            self.view.queue(1, _name='explicit')
+            self.view.queue(1, _name='explicit2')
+
+        self.assertEqual(
+            [c[1]['name'] for c in tq_add.call_args_list],
+            ['explicit', 'explicit2'])
+
+    @mock.patch.object(taskqueue.Queue, 'add')
+    def test_dedupe_batch(self, queue_add):
+        queue_add.side_effect = taskqueue.TaskAlreadyExistsError()
+
+        with mock.patch.multiple(self.view, dedupe=lambda a: a % 10,
+                                 _seen={}):
+            self.view.queue_many(((i,), {}) for i in xrange(250))
+
+        [((tasks,), _)] = queue_add.call_args_list
+        self.assertEqual(len(tasks), 10)
+
+    def test_dedupe_offloaded_payload(self):
+        """
+        Payloads of tasks that already exist are cleaned up
+        """
+        codec = payloads.PayloadCodec(offload_threshold=0)
+        with mock.patch.multiple(self.view, dedupe=lambda a: a, _seen={},
+                                 codec=codec):
+            self.view.queue(1)
+            self.view._seen.clear()
+            self.view.queue(1)
+
+            self.view._seen.clear()
+            self.view.queue_many([((1,), {}), ((2,), {})])
+
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(
+            len(stub.get_filtered_tasks(queue_names=['testqueue'])), 2)
+        self.assertEqual(payloads._TaskPayload.query().count(), 2)
+
+    def test_failed_add_offloaded_payload(self):
+        codec = payloads.PayloadCodec(offload_threshold=0)
+        with mock.patch.object(self.view, 'codec', codec), \
+                mock.patch('google.appengine.api.taskqueue.add') as tq_add:
+            tq_add.side_effect = taskqueue.InvalidEtaError()
+            with self.assertRaises(taskqueue.InvalidEtaError):
+                self.view.queue(1)
+            self.assertEqual(payloads._TaskPayload.query().count(), 0)
+
+            # The task may still have been added
+            tq_add.side_effect = taskqueue.TransientError()
+            with self.assertRaises(taskqueue.TransientError):
+                self.view.queue(1)
+            self.assertEqual(payloads._TaskPayload.query().count(), 1)
+
+    @mock.patch.object(taskqueue.Queue, 'add')
+    def test_failed_batch_offloaded_payload(self, queue_add):
+        queue_add.side_effect = taskqueue.InvalidEtaError()
+
+        codec = payloads.PayloadCodec(offload_threshold=0)
+        with mock.patch.object(self.view, 'codec', codec):
+            with self.assertRaises(queuehandler.BatchEnqueueError):
+                self.view.queue_many([((1,), {}), ((2,), {})])
+
+        self.assertEqual(payloads._TaskPayload.query().count(), 0)
+
+
+BATCH_CALL = mock.MagicMock()
+
+
+@gae.batchqueue('testqueue', batch_size=20)
+def batch_execute(i):
+    BATCH_CALL(i)
+    if i % 10 == 0:
+        raise ValueError(i)
+
+
+class BatchQueueTestCase(gae.testing.TestCase):
+    taskqueue_stub = {'root_path': os.path.dirname(__file__)}
+
+    def create_app(self):
+        app = flask.Flask(__name__)
+        app.add_url_rule('/batchhandler/', view_func=batch_execute)
+
+        @app.route('/enqueue')
+        def enqueue():
+            for i in xrange(1, 50):
+                batch_execute.queue(i)
+            return "OK"
+
+        @app.route('/enqueue-fail')
+        def enqueue_fail():
+            batch_execute.queue(1)
+            flask.abort(500)
+
+        return app
+
+    def setUp(self):
+        BATCH_CALL.reset_mock()
+
+    def get_tasks(self):
+        stub = self.testbed.get_stub('taskqueue')
+        return stub.get_filtered_tasks(queue_names=['testqueue'])
+
+    def make_request(self, items, _retries=0):
+        return self.client.post(
+            '/batchhandler/',
+            data=pickle.dumps(items),
+            headers={'X-AppEngine-QueueName': 'testqueue',
+                     'X-AppEngine-TaskRetryCount': _retries})
+
+    def test_queue_in_request(self):
+        self.assert200(self.client.get('/enqueue'))
+
+        tasks = self.get_tasks()
+        self.assertEqual(
+            sorted(len(pickle.loads(t.payload)) for t in tasks),
+            [9, 20, 20])
+
+    def test_queue_in_failed_request(self):
+        # A failed task is retried, so the calls it buffered are dropped
+        self.assert500(self.client.get('/enqueue-fail'))
+        self.assertEqual(self.get_tasks(), [])
+
+    def test_queue_outside_request(self):
+        # The test case pushes a request context, so queue from a thread.
+        def queue():
+            with self.app.app_context():
+                batch_execute.queue(1)
+
+        thread = threading.Thread(target=queue)
+        thread.start()
+        thread.join()
+
+        [task] = self.get_tasks()
+        self.assertEqual(pickle.loads(task.payload), [((1,), {})])
+
+    def test_partial_failure(self):
+        resp = self.make_request([((i,), {}) for i in xrange(1, 15)])
+        self.assert200(resp)
+        self.assertEqual(BATCH_CALL.call_count, 14)
+
+        # Only the failed call is retried, with its attempt count
+        [task] = self.get_tasks()
+        self.assertEqual(pickle.loads(task.payload), [((10,), {}, 1)])
+
+    def test_partial_failure_attempts(self):
+        """
+        Re-queued calls count their attempts and are dead lettered on
+        their own
+        """
+        with mock.patch.object(batch_execute, 'max_attempts', 3):
+            self.make_request([((1,), {}), ((10,), {})])
+            [task] = self.get_tasks()
+            self.assertEqual(pickle.loads(task.payload), [((10,), {}, 1)])
+
+            # Fails on the task's second attempt, its third overall
+            resp = self.make_request([((1,), {}), ((10,), {}, 1)],
+                                     _retries=1)
+            self.assert200(resp)
+
+        [dead] = queuehandler._DeadTask.query().fetch()
+        self.assertEqual(dead.attempts, 3)
+        self.assertEqual(pickle.loads(dead.payload), [((10,), {})])
+        self.assertIn('ValueError', dead.error)
+        self.assertEqual(len(self.get_tasks()), 1)
+
+    def test_total_failure(self):
+        resp = self.make_request([((10,), {}), ((20,), {})])
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(self.get_tasks(), [])
+
 
 class PullWorkerTestCase(gae.testing.TestCase):
     taskqueue_stub = {'root_path': os.path.dirname(__file__)}
@@ -177,6 +719,7 @@ class PullWorkerTestCase(gae.testing.TestCase):
 
     def setUp(self):
         ROW_WORKER.reset_mock()
+        ITEM_WORKER.reset_mock()
 
     @mock.patch('google.appengine.api.taskqueue.Queue')
     @mock.patch('google.appengine.api.taskqueue.Task', mock.call)
@@ -205,6 +748,62 @@ class PullWorkerTestCase(gae.testing.TestCase):
                 method='PULL')]
         )
 
+    @mock.patch.object(taskqueue.Queue, 'add')
+    @mock.patch.object(taskqueue.Queue, 'add_async')
+    def test_push_chunked(self, add_async, queue_add):
+        worker.push(*range(250))
+
+        self.assertFalse(queue_add.called)
+        self.assertEqual(
+            [len(c[0][0]) for c in add_async.call_args_list],
+            [100, 100, 50])
+        self.assertEqual(add_async.return_value.get_result.call_count, 3)
+
+    @mock.patch.object(taskqueue.Queue, 'add_async')
+    def test_push_async(self, add_async):
+        add_async.return_value.get_result.side_effect = [
+            [mock.sentinel.TASK1], taskqueue.TransientError()]
+
+        rpc = worker.push_async(*range(150))
+        self.assertEqual(add_async.call_count, 2)
+
+        with self.assertRaises(taskqueue.TransientError):
+            rpc.get_result()
+
+    def test_push_later(self):
+        app = self.app
+
+        @app.route('/push-later')
+        def push_later():
+            for i in xrange(150):
+                worker.push_later(i)
+
+            # Nothing is added until the request finishes
+            self.assertEqual(
+                len(taskqueue.Queue('pullqueue').lease_tasks(60, 1000)), 0)
+            return "OK"
+
+        with mock.patch.object(taskqueue.Queue, 'add_async',
+                               wraps=taskqueue.Queue('pullqueue').add_async
+                               ) as add_async:
+            self.assert200(self.client.get('/push-later'))
+
+        self.assertEqual(add_async.call_count, 2)
+        self.assertEqual(
+            len(taskqueue.Queue('pullqueue').lease_tasks(60, 1000)), 150)
+
+    def test_push_later_failed_request(self):
+        app = self.app
+
+        @app.route('/push-later-fail')
+        def push_later_fail():
+            worker.push_later(1)
+            flask.abort(500)
+
+        self.assert500(self.client.get('/push-later-fail'))
+        self.assertEqual(
+            len(taskqueue.Queue('pullqueue').lease_tasks(60, 1000)), 0)
+
     @mock.patch.object(taskqueue.Queue, 'delete_tasks')
     @mock.patch.object(taskqueue.Queue, 'lease_tasks',
                        wraps=taskqueue.Queue('pullqueue').lease_tasks)
@@ -228,6 +827,204 @@ class PullWorkerTestCase(gae.testing.TestCase):
             delete_tasks.call_args_list,
             [mock.call([mock.ANY]*50), mock.call([mock.ANY]*50)])
 
+    @mock.patch.object(taskqueue.Queue, 'delete_tasks_async')
+    @mock.patch.object(taskqueue.Queue, 'lease_tasks_async',
+                       wraps=taskqueue.Queue('pullqueue').lease_tasks_async)
+    def test_pull_pipelined(self, lease_tasks_async, delete_tasks_async):
+        for i in xrange(100):
+            worker.push(i)
+
+        with mock.patch.object(worker, 'prefetch', 1):
+            worker._pull(self.app)
+
+        self.assertEqual(ROW_WORKER.call_args_list,
+                         [mock.call(i) for i in xrange(100)])
+
+        # The first two leases are issued up front, and leasing stops
+        # after the first empty one.
+        self.assertEqual(
+            lease_tasks_async.call_args_list,
+            [mock.call(123, 50)] * 4)
+
+        self.assertEqual(
+            delete_tasks_async.call_args_list,
+            [mock.call([mock.ANY]*50), mock.call([mock.ANY]*50)])
+        self.assertEqual(
+            delete_tasks_async.return_value.get_result.call_count, 2)
+
+    def test_pull_missing_payload(self):
+        """
+        Tasks whose payloads were already cleaned up are deleted unrun
+        """
+        with mock.patch.object(worker, 'codec',
+                               payloads.PayloadCodec(offload_threshold=0)):
+            worker.push(1, 2)
+        ndb.delete_multi(payloads._TaskPayload.query().fetch(keys_only=True))
+
+        self.run_pull_worker(worker)
+        self.assertFalse(ROW_WORKER.called)
+        self.assertEqual(
+            taskqueue.Queue('pullqueue').lease_tasks(60, 100), [])
+
+    @mock.patch.object(taskqueue.Queue, 'delete_tasks_async')
+    def test_pull_streaming_delete(self, delete_tasks_async):
+        for i in xrange(100):
+            worker.push(i)
+
+        with mock.patch.object(worker, 'delete_batch_size', 20):
+            worker._pull(self.app)
+
+        # Tasks are deleted as they are yielded, and the remainder of each
+        # leased batch when it finishes.
+        self.assertEqual(
+            [len(c[0][0]) for c in delete_tasks_async.call_args_list],
+            [20, 20, 10, 20, 20, 10])
+        self.assertEqual(
+            delete_tasks_async.return_value.get_result.call_count, 6)
+
+    def test_task_deleter_interval(self):
+        queue = mock.Mock()
+        deleter = queuehandler._TaskDeleter(queue, mock.Mock(), interval=5)
+
+        with mock.patch('time.time', return_value=deleter.flushed_at + 1):
+            deleter.add([mock.sentinel.TASK1])
+        self.assertFalse(queue.delete_tasks.called)
+
+        with mock.patch('time.time', return_value=deleter.flushed_at + 6):
+            deleter.add([mock.sentinel.TASK2])
+        queue.delete_tasks.assert_called_once_with(
+            [mock.sentinel.TASK1, mock.sentinel.TASK2])
+
+    @mock.patch.object(taskqueue.Queue, 'delete_tasks')
+    def test_pull_per_item(self, delete_tasks):
+        for i in xrange(30):
+            worker.push(i)
+
+        item_worker._pull(self.app)
+
+        self.assertItemsEqual(ITEM_WORKER.call_args_list,
+                              [mock.call(i) for i in xrange(30)])
+
+        # Failed items are not deleted
+        deleted = [pickle.loads(t.payload)
+                   for t in delete_tasks.call_args[0][0]]
+        self.assertItemsEqual(deleted,
+                              [i for i in xrange(30) if i % 10 != 0])
+
+    @mock.patch.object(taskqueue.Queue, 'delete_tasks')
+    def test_pull_per_item_tasklets(self, delete_tasks):
+        for i in xrange(30):
+            worker.push(i)
+
+        tasklet_worker._pull(self.app)
+
+        self.assertItemsEqual(ITEM_WORKER.call_args_list,
+                              [mock.call(i) for i in xrange(30)])
+
+        deleted = [pickle.loads(t.payload)
+                   for t in delete_tasks.call_args[0][0]]
+        self.assertItemsEqual(deleted,
+                              [i for i in xrange(30) if i % 10 != 0])
+
+    def test_lease_sizer(self):
+        sizer = queuehandler._LeaseSizer(10, target_seconds=10,
+                                         lease_seconds=60)
+        # Fast tasks grow the lease, but at most doubling each time
+        sizer.record(10, 1.0)
+        self.assertEqual(sizer.size, 20)
+
+        # Slow tasks shrink it
+        sizer.record(20, 200.0)
+        self.assertEqual(sizer.size, 1)
+
+    def test_lease_sizer_disabled(self):
+        sizer = queuehandler._LeaseSizer(50)
+        sizer.record(50, 1000.0)
+        self.assertEqual(sizer.size, 50)
+
+    @mock.patch.object(taskqueue.Queue, 'modify_task_lease')
+    def test_extend_leases(self, modify_task_lease):
+        tasks = [mock.Mock(payload=pickle.dumps(i)) for i in xrange(3)]
+        for i, t in enumerate(tasks):
+            t.name = 'task-{}'.format(i)
+
+        lock = mock.Mock()
+        deleter = mock.Mock()
+        sizer = queuehandler._LeaseSizer(50)
+
+        with mock.patch.object(worker, 'extend_leases', True):
+            # Leased long enough ago that the lease is nearly up.
+            worker._process(tasks, lock, deleter, sizer, 0)
+
+        # Extended once after the first task, then the lease is fresh.
+        self.assertEqual(
+            modify_task_lease.call_args_list,
+            [mock.call(tasks[1], 123), mock.call(tasks[2], 123)])
+        # The lock is refreshed along with the leases
+        lock.refresh.assert_called_once_with()
+
+    @mock.patch.object(taskqueue.Queue, 'modify_task_lease')
+    def test_extend_leases_lost_lock(self, modify_task_lease):
+        tasks = [mock.Mock(payload=pickle.dumps(i)) for i in xrange(3)]
+        for i, t in enumerate(tasks):
+            t.name = 'task-{}'.format(i)
+
+        lock = mock.Mock()
+        lock.refresh.return_value = False
+        deleter = mock.Mock()
+        sizer = queuehandler._LeaseSizer(50)
+
+        with mock.patch.object(worker, 'extend_leases', True):
+            worker._process(tasks, lock, deleter, sizer, 0)
+
+        # Another worker has the slot, so stop without extending
+        self.assertFalse(modify_task_lease.called)
+        self.assertEqual(ROW_WORKER.call_args_list, [mock.call(0)])
+
+    def test_process_refreshes_lock(self):
+        tasks = [mock.Mock(payload=pickle.dumps(i)) for i in xrange(3)]
+        for i, t in enumerate(tasks):
+            t.name = 'task-{}'.format(i)
+
+        lock = mock.Mock()
+        deleter = mock.Mock()
+        sizer = queuehandler._LeaseSizer(50)
+
+        # Each task takes longer than half the lock's TTL
+        clock = itertools.count(0, 200)
+        with mock.patch('time.time', lambda: next(clock)):
+            worker._process(tasks, lock, deleter, sizer, 0)
+
+        self.assertEqual(lock.refresh.call_count, 3)
+
+    def test_run_pull_worker(self):
+        for i in xrange(10):
+            worker.push(i)
+
+        self.run_pull_worker(worker)
+        self.assertEqual(ROW_WORKER.call_args_list,
+                         [mock.call(i) for i in xrange(10)])
+
+    @mock.patch.object(taskqueue.Queue, 'delete_tasks')
+    def test_pull_metrics(self, delete_tasks):
+        sink = gae.metrics.MemorySink()
+        for i in xrange(60):
+            worker.push(i)
+
+        with mock.patch.object(worker, 'metrics_sink', sink):
+            worker._pull(self.app)
+
+        snapshot = sink.snapshot()
+        self.assertEqual(snapshot['counters'], {'pull.worker.deleted': 60})
+        self.assertEqual(snapshot['timings']['pull.worker.lease']['count'],
+                         3)
+        self.assertEqual(
+            snapshot['timings']['pull.worker.execute']['count'], 2)
+        self.assertEqual(snapshot['gauges'], {
+            'pull.worker.batch_size': 0,
+            'pull.worker.lease_utilization': 0.0,
+        })
+
     def test_pull_tags(self):
         pass
 
@@ -241,6 +1038,102 @@ class PullWorkerTestCase(gae.testing.TestCase):
         self.assertFalse(delete_tasks.called)
         self.assertFalse(ROW_WORKER.called)
 
+    def test_datastore_lock(self):
+        Lock = queuehandler._PullWorkerLock
+
+        lock = Lock.acquire('pullqueue', 1)
+        self.assertTrue(lock)
+        self.assertFalse(Lock.acquire('pullqueue', 1))
+        self.assertEqual(Lock.active_workers('pullqueue'), 1)
+
+        lock.release()
+        self.assertEqual(Lock.active_workers('pullqueue'), 0)
+
+    def test_default_lock_processes_tasks(self):
+        """
+        Workers using the default datastore lock drain the queue
+        """
+        self.assertIs(worker.lock_class, queuehandler._PullWorkerLock)
+        for i in xrange(10):
+            worker.push(i)
+
+        self.run_pull_worker(worker)
+        self.assertEqual(ROW_WORKER.call_count, 10)
+        self.assertEqual(
+            taskqueue.Queue('pullqueue').lease_tasks(60, 100), [])
+        self.assertEqual(
+            queuehandler._PullWorkerLock.active_workers('pullqueue'), 0)
+
+    def test_slot_lock(self):
+        Slot = queuehandler._PullWorkerSlot
+
+        lock1 = Slot.acquire('pullqueue', 2, ttl=60)
+        lock2 = Slot.acquire('pullqueue', 2, ttl=60)
+        self.assertTrue(lock1)
+        self.assertTrue(lock2)
+        self.assertNotEqual(lock1.key, lock2.key)
+
+        # All slots are taken
+        self.assertFalse(Slot.acquire('pullqueue', 2, ttl=60))
+
+        lock1.release()
+        self.assertTrue(Slot.acquire('pullqueue', 2, ttl=60))
+
+    def test_slot_lock_expiry(self):
+        Slot = queuehandler._PullWorkerSlot
+
+        lock1 = Slot.acquire('pullqueue', 1, ttl=60)
+        self.assertTrue(lock1.refresh())
+
+        # The holder died without releasing the slot
+        lock1.expires = datetime.datetime.utcnow()
+        lock1.put()
+
+        lock2 = Slot.acquire('pullqueue', 1, ttl=60)
+        self.assertTrue(lock2)
+
+        # The original holder finds out it lost the slot.
+        self.assertFalse(lock1.refresh())
+        lock1.release()
+        self.assertTrue(lock2.refresh())
+
+    def test_memcache_slot_lock(self):
+        Slot = queuehandler._MemcachePullWorkerSlot
+
+        lock1 = Slot.acquire('pullqueue', 1, ttl=60)
+        self.assertTrue(lock1)
+
+        # Saturated queues are detected without touching the datastore
+        with mock.patch.object(ndb, 'get_multi') as get_multi:
+            self.assertFalse(Slot.acquire('pullqueue', 1, ttl=60))
+        self.assertFalse(get_multi.called)
+
+        lock1.release()
+        self.assertTrue(Slot.acquire('pullqueue', 1, ttl=60))
+
+    def test_memcache_slot_lock_evicted(self):
+        """
+        The datastore still guards the slot if memcache is flushed.
+        """
+        Slot = queuehandler._MemcachePullWorkerSlot
+
+        self.assertTrue(Slot.acquire('pullqueue', 1, ttl=60))
+        memcache.flush_all()
+        self.assertFalse(Slot.acquire('pullqueue', 1, ttl=60))
+
+    @mock.patch.object(queuehandler._PullWorkerSlot, 'refresh')
+    def test_memcache_slot_heartbeat(self, datastore_refresh):
+        lock = queuehandler._MemcachePullWorkerSlot.acquire(
+            'pullqueue', 1, ttl=60)
+
+        # Fresh slots only heartbeat to memcache
+        self.assertTrue(lock.refresh())
+        self.assertFalse(datastore_refresh.called)
+
+        lock.expires = datetime.datetime.utcnow()
+        self.assertTrue(lock.refresh())
+        datastore_refresh.assert_called_once_with()
+
     @mock.patch.object(queuehandler, 'start_new_background_thread')
     def test_get(self, bg_thread):
         self.client.get('/worker')
@@ -249,3 +1142,170 @@ class PullWorkerTestCase(gae.testing.TestCase):
     def test_start(self):
         pass
 
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    def test_delayed_start(self, bg_thread):
+        with mock.patch('time.time', return_value=6000):
+            with self.app.test_request_context():
+                worker.start(delay=60)
+                worker.start(delay=60)
+
+        self.assertFalse(bg_thread.called)
+
+        stub = self.testbed.get_stub('taskqueue')
+        [task] = stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(task.url, '/worker')
+        self.assertEqual(task.name,
+                         'pullqueue-module-test_blueprint_worker-start-60-101')
+
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    def test_delayed_start_targets(self, bg_thread):
+        # Starts on other modules or of other handlers have their own task
+        with mock.patch('time.time', return_value=6000):
+            with self.app.test_request_context():
+                worker.start(module='a', delay=60)
+                worker.start(module='b', delay=60)
+                item_worker.start(module='a', delay=60)
+
+        stub = self.testbed.get_stub('taskqueue')
+        tasks = stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(
+            sorted(t.name for t in tasks),
+            ['pullqueue-a-test_blueprint_item_worker-start-60-101',
+             'pullqueue-a-test_blueprint_worker-start-60-101',
+             'pullqueue-b-test_blueprint_worker-start-60-101'])
+
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    def test_delayed_start_fractional(self, bg_thread):
+        with mock.patch('time.time', return_value=6000):
+            with self.app.test_request_context():
+                worker.start(delay=1.5)
+                worker.start(delay=0.5)
+
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(
+            sorted(t.name for t in
+                   stub.get_filtered_tasks(queue_names=['default'])),
+            ['pullqueue-module-test_blueprint_worker-start-1-6000',
+             'pullqueue-module-test_blueprint_worker-start-1-6001'])
+
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    def test_get_delay(self, bg_thread):
+        """
+        Requests with a delay schedule a start instead of sleeping
+        """
+        resp = self.client.get('/worker?delay=60')
+        self.assertEqual(resp.data, "Delayed start by 60 seconds")
+        self.assertFalse(bg_thread.called)
+
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(
+            len(stub.get_filtered_tasks(queue_names=['default'])), 1)
+
+    @mock.patch.object(urlfetch, 'make_fetch_call')
+    def test_start_async(self, make_fetch_call):
+        with self.app.test_request_context():
+            rpc = worker.start_async()
+
+        [(call_rpc, url), _] = make_fetch_call.call_args
+        self.assertIs(call_rpc, rpc)
+        self.assertTrue(url.startswith('https://module-dot-'))
+        self.assertTrue(url.endswith('/worker'))
+
+    @mock.patch.object(urlfetch, 'make_fetch_call')
+    def test_start_window(self, make_fetch_call):
+        with mock.patch.object(worker, 'start_window', 60), \
+                mock.patch.object(worker, '_started', {}), \
+                self.app.test_request_context():
+            self.assertIsNotNone(worker.start_async())
+            self.assertIsNone(worker.start_async())
+            self.assertIsNotNone(worker.start_async('other-module'))
+
+            with mock.patch('time.time', return_value=time.time() + 61):
+                self.assertIsNotNone(worker.start_async())
+
+        self.assertEqual(make_fetch_call.call_count, 3)
+
+    def test_start_window_failure(self):
+        """
+        Failed starts don't hold the start window
+        """
+        with mock.patch.object(worker, 'start_window', 60), \
+                mock.patch.object(worker, '_started', {}), \
+                self.app.test_request_context():
+            with mock.patch.object(urlfetch, 'make_fetch_call',
+                                   side_effect=urlfetch.Error()):
+                with self.assertRaises(urlfetch.Error):
+                    worker.start_async()
+
+            with mock.patch.object(urlfetch, 'create_rpc') as create_rpc, \
+                    mock.patch.object(urlfetch, 'make_fetch_call'):
+                create_rpc.return_value.get_result.side_effect = \
+                    urlfetch.DeadlineExceededError()
+                with self.assertRaises(urlfetch.DeadlineExceededError):
+                    worker.start()
+
+                create_rpc.return_value.get_result.side_effect = None
+                worker.start()
+                self.assertEqual(
+                    create_rpc.return_value.get_result.call_count, 2)
+
+    @mock.patch.object(urlfetch, 'make_fetch_call')
+    def test_start_no_wait(self, make_fetch_call):
+        with mock.patch.object(urlfetch, 'create_rpc') as create_rpc, \
+                self.app.test_request_context():
+            worker.start(wait=False)
+            self.assertFalse(create_rpc.return_value.get_result.called)
+
+            worker.start()
+            create_rpc.return_value.get_result.assert_called_once_with()
+
+    def test_wanted_workers(self):
+        handler = gae.pullqueue('pullqueue', 'module', lease_size=100,
+                                max_workers=5)
+        stats = mock.Mock(tasks=250, oldest_eta_usec=None)
+        self.assertEqual(handler._wanted_workers(stats), 3)
+
+        stats.tasks = 10000
+        self.assertEqual(handler._wanted_workers(stats), 5)
+
+        stats.tasks = 0
+        self.assertEqual(handler._wanted_workers(stats), 0)
+
+        # Tasks that can't be leased yet
+        stats.tasks = 250
+        stats.oldest_eta_usec = (time.time() + 60) * 1e6
+        self.assertEqual(handler._wanted_workers(stats), 0)
+
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    @mock.patch.object(taskqueue.Queue, 'fetch_statistics')
+    def test_autoscale(self, fetch_statistics, bg_thread):
+        fetch_statistics.return_value = mock.Mock(
+            tasks=120, oldest_eta_usec=None)
+
+        with mock.patch.multiple(worker, max_workers=5,
+                                 autoscale_interval=30):
+            resp = self.client.get('/worker?autoscale=1')
+            self.assertEqual(resp.data, "Started 3 workers")
+            self.assertEqual(bg_thread.call_count, 3)
+
+            # Calling again in the same window doesn't add another task
+            self.client.get('/worker?autoscale=1')
+
+        stub = self.testbed.get_stub('taskqueue')
+        [task] = stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(task.url, '/worker?autoscale=1')
+        self.assertEqual(task.method, 'GET')
+
+    @mock.patch.object(queuehandler, 'start_new_background_thread')
+    @mock.patch.object(taskqueue.Queue, 'fetch_statistics')
+    def test_autoscale_empty(self, fetch_statistics, bg_thread):
+        fetch_statistics.return_value = mock.Mock(
+            tasks=0, oldest_eta_usec=None)
+
+        with mock.patch.object(worker, 'autoscale_interval', 30):
+            self.client.get('/worker?autoscale=1')
+
+        self.assertFalse(bg_thread.called)
+        stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(stub.get_filtered_tasks(queue_names=['default']), [])
+
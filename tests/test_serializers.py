@@ -0,0 +1,34 @@
+import unittest
+import cPickle as pickle
+
+from flask.ext.gae import serializers
+
+
+class SerializerTestCase(unittest.TestCase):
+    def test_pickle(self):
+        data = serializers.PICKLE.dumps(((1, 2), {'kw': 'arg'}))
+        self.assertEqual(serializers.PICKLE.loads(data),
+                         ((1, 2), {'kw': 'arg'}))
+        # Highest protocol pickles start with the PROTO opcode
+        self.assertTrue(data.startswith('\x80'))
+
+    def test_pickle_protocol_0(self):
+        # Payloads from before serializers existed are still loadable
+        data = pickle.dumps(((1, 2), {'kw': 'arg'}))
+        self.assertEqual(serializers.PICKLE.loads(data),
+                         ((1, 2), {'kw': 'arg'}))
+
+    def test_json(self):
+        data = serializers.JSON.dumps(((1, 2), {'kw': 'arg'}))
+        self.assertEqual(data, '[[1,2],{"kw":"arg"}]')
+        self.assertEqual(serializers.JSON.loads(data),
+                         [[1, 2], {'kw': 'arg'}])
+
+    def test_for_content_type(self):
+        self.assertIs(serializers.for_content_type('application/json'),
+                      serializers.JSON)
+        self.assertIs(serializers.for_content_type(None),
+                      serializers.PICKLE)
+        self.assertIs(
+            serializers.for_content_type('application/octet-stream'),
+            serializers.PICKLE)